@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "linuxmint", "mintsysadm"))
+from common.imaging import reduce_image
+from PIL import Image
+
+# The importer needs the whole GTK stack
+HAVE_GTK = all(importlib.util.find_spec(module) is not None for module in ("gi", "cairo", "xapp"))
+
+def make_palette_png(directory, size=(2000, 1500), transparency=None):
+    pil_image = Image.new("RGB", size, (200, 30, 30)).quantize(16)
+    path = os.path.join(directory, "palette.png")
+    if transparency is not None:
+        pil_image.save(path, transparency=transparency)
+    else:
+        pil_image.save(path)
+    return path
+
+class ReduceImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_large_palette_png(self):
+        with Image.open(make_palette_png(self.directory.name)) as pil_image:
+            self.assertEqual(pil_image.mode, "P")
+            reduced = reduce_image(pil_image, 512)
+        self.assertEqual(reduced.mode, "RGB")
+        self.assertEqual(reduced.size, (1000, 750))
+
+    def test_transparent_palette_keeps_alpha(self):
+        with Image.open(make_palette_png(self.directory.name, transparency=0)) as pil_image:
+            reduced = reduce_image(pil_image, 512)
+        self.assertEqual(reduced.mode, "RGBA")
+
+    def test_modes_without_reduce(self):
+        for mode in ("1", "I;16", "CMYK"):
+            with self.subTest(mode=mode):
+                reduced = reduce_image(Image.new(mode, (2000, 1500)), 512)
+                self.assertEqual(reduced.mode, "RGB")
+                self.assertEqual(reduced.size, (1000, 750))
+
+    def test_small_images_are_not_reduced(self):
+        reduced = reduce_image(Image.new("LA", (600, 900)), 512)
+        self.assertEqual(reduced.mode, "RGBA")
+        self.assertEqual(reduced.size, (600, 900))
+
+@unittest.skipUnless(HAVE_GTK, "needs gi, cairo and xapp")
+class AvatarImporterTest(unittest.TestCase):
+
+    def test_large_palette_png(self):
+        from common.user import AvatarImporter, avatar_encoding
+        with tempfile.TemporaryDirectory() as directory:
+            importer = AvatarImporter(make_palette_png(directory), None)
+            temp_path = importer.import_image()
+            try:
+                with Image.open(temp_path) as pil_image:
+                    self.assertEqual(pil_image.size, (avatar_encoding.size, avatar_encoding.size))
+            finally:
+                os.remove(temp_path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "linuxmint", "mintsysadm"))
+from common.logins import LoginLog, LoginSession, UTMP_BOOT_TIME, UTMP_DEAD_PROCESS, UTMP_STRUCT, UTMP_USER_PROCESS
+
+def login(user, line, seconds):
+    return UTMP_STRUCT.pack(UTMP_USER_PROCESS, 1, line.encode(), b"", user.encode(), b"", 0, 0, 0, seconds, 0, b"")
+
+def logout(line, seconds):
+    return UTMP_STRUCT.pack(UTMP_DEAD_PROCESS, 1, line.encode(), b"", b"", b"", 0, 0, 0, seconds, 0, b"")
+
+def boot(seconds):
+    return UTMP_STRUCT.pack(UTMP_BOOT_TIME, 0, b"~", b"~~", b"reboot", b"", 0, 0, 0, seconds, 0, b"")
+
+class LoginLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "wtmp")
+        open(self.path, "wb").close()
+        self.log = LoginLog(self.path)
+
+    def tearDown(self):
+        self.log.close()
+        self.directory.cleanup()
+
+    def append(self, *records):
+        with open(self.path, "ab") as log_file:
+            log_file.write(b"".join(records))
+
+    def get_ends(self, user_name, before=None, count=10):
+        sessions, more = self.log.get_sessions(user_name, before, count)
+        return [(session.login_time, session.logout_time, session.end) for session in sessions]
+
+    def test_appended_records_are_indexed(self):
+        self.append(login("alice", "tty1", 10), logout("tty1", 20), login("alice", "tty2", 30))
+        self.assertEqual(self.get_ends("alice"), [(30, None, LoginSession.END_ACTIVE),
+                                                  (10, 20, LoginSession.END_LOGOUT)])
+        self.append(logout("tty2", 40), login("alice", "tty1", 50))
+        self.assertEqual(self.get_ends("alice"), [(50, None, LoginSession.END_ACTIVE),
+                                                  (30, 40, LoginSession.END_LOGOUT),
+                                                  (10, 20, LoginSession.END_LOGOUT)])
+
+    def test_appended_boot_ends_active_sessions(self):
+        self.append(login("alice", "tty1", 10), login("bob", "tty2", 20))
+        self.get_ends("alice")
+        self.append(boot(30))
+        self.assertEqual(self.get_ends("alice"), [(10, 30, LoginSession.END_CRASH)])
+        self.assertEqual(self.get_ends("bob"), [(20, 30, LoginSession.END_CRASH)])
+
+    def test_appended_logouts_reach_records_not_scanned_yet(self):
+        self.append(login("alice", "tty1", 10), login("bob", "tty2", 20))
+        self.log.open()
+        self.log.scan(1) # Only bob's login
+        self.append(logout("tty1", 30), logout("tty2", 40))
+        self.assertEqual(self.get_ends("bob"), [(20, 40, LoginSession.END_LOGOUT)])
+        self.assertEqual(self.get_ends("alice"), [(10, 30, LoginSession.END_LOGOUT)])
+
+    def test_pages_follow_the_cursor(self):
+        self.append(*[login("alice", "pts/%d" % index, index) for index in range(5)])
+        first, more = self.log.get_sessions("alice", None, 2)
+        self.assertTrue(more)
+        self.append(login("alice", "pts/9", 100))
+        second, more = self.log.get_sessions("alice", first[-1].offset, 2)
+        self.assertEqual([session.login_time for session in first + second], [4, 3, 2, 1])
+
+    def test_rotated_log_is_indexed_again(self):
+        self.append(login("alice", "tty1", 10))
+        self.get_ends("alice")
+        os.rename(self.path, self.path + ".1")
+        open(self.path, "wb").close()
+        self.append(login("bob", "tty1", 20))
+        self.assertEqual(self.get_ends("alice"), [])
+        self.assertEqual(self.get_ends("bob"), [(20, None, LoginSession.END_ACTIVE)])
+
+if __name__ == "__main__":
+    unittest.main()
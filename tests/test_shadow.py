@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "linuxmint", "mintsysadm"))
+from common.shadow import expire_passwords
+
+SHADOW = ("root:*:19000:0:99999:7:::\n"
+          "alice:$y$j9T$salt$hash:19500:1:90:7:30:20000:\n"
+          "bob:!:19600:0:99999:7:::\n"
+          "carol:$6$salt$hash:19700::::::")
+
+class ExpirePasswordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "shadow")
+        with open(self.path, "w") as shadow_file:
+            shadow_file.write(SHADOW)
+        os.chmod(self.path, 0o640)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, path):
+        with open(path, "r") as shadow_file:
+            return shadow_file.read()
+
+    def test_only_the_last_change_date_is_reset(self):
+        expire_passwords(["alice", "carol"], self.path)
+        lines = self.read(self.path).splitlines()
+        self.assertEqual(lines, ["root:*:19000:0:99999:7:::",
+                                 "alice:$y$j9T$salt$hash:0:1:90:7:30:20000:",
+                                 "bob:!:19600:0:99999:7:::",
+                                 "carol:$6$salt$hash:0::::::"])
+
+    def test_missing_users_are_returned(self):
+        self.assertEqual(expire_passwords(["bob", "dave"], self.path), {"dave"})
+        self.assertIn("bob:!:0:0:99999:7:::", self.read(self.path).splitlines())
+
+    def test_nothing_is_written_without_known_users(self):
+        self.assertEqual(expire_passwords(["dave"], self.path), {"dave"})
+        self.assertEqual(self.read(self.path), SHADOW)
+        self.assertFalse(os.path.exists(self.path + "-"))
+
+    def test_mode_is_kept_and_a_backup_is_written(self):
+        expire_passwords(["bob"], self.path)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertEqual(self.read(self.path + "-"), SHADOW)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path + "-").st_mode), 0o640)
+        self.assertFalse(os.path.exists(self.path + "+"))
+
+if __name__ == "__main__":
+    unittest.main()
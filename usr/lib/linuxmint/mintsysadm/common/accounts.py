@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+import gi
+import grp
+import os
+import pwd
+import subprocess
+import time
+import unicodedata
+gi.require_version("AccountsService", "1.0")
+from gi.repository import AccountsService, Gio, GLib, GObject
+
+NSS_CACHE_TIMEOUT = 30 # seconds
+SESSIONS_REFRESH_DELAY = 200 # ms
+GROUPS_RELOAD_DELAY = 200 # ms
+GROUP_PATH = "/etc/group"
+GSHADOW_PATH = "/etc/gshadow"
+
+# Usernames of the accounts, kept current from the user manager signals.
+# Accounts AccountsService doesn't list (system accounts, or accounts only
+# known to NSS, e.g. from LDAP) are looked up with getpwnam, and the
+# results are cached for a little while, so validating a username as it's
+# typed doesn't query the directory for every keystroke.
+class UserIndex():
+
+    def __init__(self, manager=None):
+        self.manager = manager if manager is not None else AccountsService.UserManager.get_default()
+        self.names = {} # username -> user
+        self.nss_names = {} # username -> (exists, time of the lookup)
+        self.manager.connect("notify::is-loaded", self.on_manager_loaded)
+        self.manager.connect("user-added", self.on_user_added)
+        self.manager.connect("user-removed", self.on_user_removed)
+        if self.manager.get_property("is-loaded"):
+            self.rebuild()
+
+    def rebuild(self):
+        self.names = {}
+        for user in self.manager.list_users():
+            self.add(user)
+
+    def add(self, user):
+        self.names[user.get_user_name()] = user
+        self.nss_names.pop(user.get_user_name(), None)
+
+    def remove(self, user):
+        if self.names.get(user.get_user_name()) is user:
+            del self.names[user.get_user_name()]
+        self.nss_names.pop(user.get_user_name(), None)
+
+    def on_manager_loaded(self, manager, param):
+        if manager.get_property("is-loaded"):
+            self.rebuild()
+
+    def on_user_added(self, manager, user):
+        self.add(user)
+
+    def on_user_removed(self, manager, user):
+        self.remove(user)
+
+    def get_user(self, user_name):
+        user = self.names.get(user_name)
+        # Users can be renamed behind our back
+        if user is not None and user.get_user_name() == user_name:
+            return user
+        return None
+
+    # Usernames known to AccountsService, safe to use from a thread
+    def get_user_names(self):
+        return set(self.names.keys())
+
+    def user_exists(self, user_name):
+        if self.get_user(user_name) is not None:
+            return True
+        return self.lookup_nss(user_name)
+
+    def lookup_nss(self, user_name):
+        now = time.monotonic()
+        entry = self.nss_names.get(user_name)
+        if entry is not None and now - entry[1] < NSS_CACHE_TIMEOUT:
+            return entry[0]
+        try:
+            pwd.getpwnam(user_name)
+            exists = True
+        except (KeyError, ValueError):
+            exists = False
+        self.nss_names[user_name] = (exists, now)
+        return exists
+
+user_index = None
+
+def get_user_index():
+    global user_index
+    if user_index is None:
+        user_index = UserIndex()
+    return user_index
+
+# The sessions of logged-in users, from logind.
+# The whole list is fetched with a single ListSessions call, and fetched again
+# (once per burst) when logind announces a new or a removed session.
+# Until the first list arrives, nobody is known to be logged in, check is_loaded().
+class SessionIndex(GObject.Object):
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self):
+        super(SessionIndex, self).__init__()
+        self.proxy = None
+        self.sessions = {} # session id -> username
+        self.counts = {} # username -> number of sessions
+        self.loaded = False
+        self.refresh_timer = 0
+        Gio.DBusProxy.new_for_bus(Gio.BusType.SYSTEM, Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES, None,
+                                  "org.freedesktop.login1", "/org/freedesktop/login1", "org.freedesktop.login1.Manager",
+                                  None, self.on_proxy_ready)
+
+    def on_proxy_ready(self, source, result):
+        try:
+            self.proxy = Gio.DBusProxy.new_for_bus_finish(result)
+        except GLib.Error as e:
+            print(f"Unable to connect to logind: {e.message}")
+            self.set_loaded()
+            return
+        self.proxy.connect("g-signal", self.on_signal)
+        self.refresh()
+
+    def on_signal(self, proxy, sender_name, signal_name, parameters):
+        if signal_name in ("SessionNew", "SessionRemoved") and self.refresh_timer == 0:
+            self.refresh_timer = GLib.timeout_add(SESSIONS_REFRESH_DELAY, self.refresh)
+
+    def refresh(self):
+        self.refresh_timer = 0
+        self.proxy.call("ListSessions", None, Gio.DBusCallFlags.NONE, -1, None, self.on_sessions_listed)
+        return False
+
+    def on_sessions_listed(self, proxy, result):
+        try:
+            sessions = proxy.call_finish(result).unpack()[0]
+        except GLib.Error as e:
+            print(f"Unable to list sessions: {e.message}")
+            self.set_loaded()
+            return
+        # (session id, uid, username, seat, object path)
+        self.sessions = {session[0]: session[2] for session in sessions}
+        self.counts = {}
+        for user_name in self.sessions.values():
+            self.counts[user_name] = self.counts.get(user_name, 0) + 1
+        self.loaded = True
+        self.emit("changed")
+
+    # Without logind, sessions can't be known, don't wait for them forever
+    def set_loaded(self):
+        if not self.loaded:
+            self.loaded = True
+            self.emit("changed")
+
+    def is_loaded(self):
+        return self.loaded
+
+    def get_session_count(self, user_name):
+        return self.counts.get(user_name, 0)
+
+    def is_logged_in(self, user_name):
+        return user_name in self.counts
+
+session_index = None
+
+def get_session_index():
+    global session_index
+    if session_index is None:
+        session_index = SessionIndex()
+    return session_index
+
+# Return the entries of /etc/group or /etc/gshadow, split in fields
+def read_group_file(path):
+    entries = []
+    with open(path, "r", errors="replace") as group_file:
+        for line in group_file:
+            fields = line.rstrip("\n").split(":")
+            if len(fields) < 4 or fields[0] == "" or fields[0].startswith(("+", "-")):
+                continue
+            entries.append(fields)
+    return entries
+
+def split_members(field):
+    return [member for member in field.split(",") if member != ""]
+
+# Return the members of the groups defined in /etc/group.
+# Unlike grp, this bypasses NSS caches, which matters when rewriting member lists.
+def read_local_groups(path=GROUP_PATH):
+    return {fields[0]: split_members(fields[3]) for fields in read_group_file(path)}
+
+# The local groups, indexed both ways (group -> members and member -> groups).
+# The group files are monitored and only parsed again when they change.
+class GroupIndex(GObject.Object):
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self, group_path=GROUP_PATH, gshadow_path=GSHADOW_PATH):
+        super(GroupIndex, self).__init__()
+        self.group_path = group_path
+        self.gshadow_path = gshadow_path
+        self.gids = {} # group -> gid
+        self.members = {} # group -> set of usernames
+        self.user_groups = {} # username -> set of groups
+        self.signature = None
+        self.reload_timer = 0
+        self.monitors = []
+        self.load()
+        for path in (group_path, gshadow_path):
+            try:
+                monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as e:
+                print(f"Unable to monitor '{path}': {e.message}")
+                continue
+            monitor.connect("changed", self.on_file_changed)
+            self.monitors.append(monitor)
+
+    def get_signature(self):
+        signature = []
+        for path in (self.group_path, self.gshadow_path):
+            try:
+                stat_info = os.stat(path)
+                signature.append((stat_info.st_ino, stat_info.st_mtime_ns, stat_info.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    # Parse the files if they changed, return True if they did
+    def load(self):
+        signature = self.get_signature()
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        self.gids = {}
+        self.members = {}
+        try:
+            for fields in read_group_file(self.group_path):
+                try:
+                    self.gids[fields[0]] = int(fields[2])
+                except ValueError:
+                    continue
+                self.members[fields[0]] = set(split_members(fields[3]))
+        except OSError as e:
+            print(f"Unable to read '{self.group_path}': {e}")
+        # gshadow is only readable by root, and should list the same members
+        try:
+            for fields in read_group_file(self.gshadow_path):
+                if fields[0] in self.members:
+                    self.members[fields[0]].update(split_members(fields[3]))
+        except OSError:
+            pass
+        self.user_groups = {}
+        for group, members in self.members.items():
+            for member in members:
+                self.user_groups.setdefault(member, set()).add(group)
+        return True
+
+    def on_file_changed(self, monitor, file, other_file, event_type):
+        # The files are replaced a few times in a row by the shadow tools
+        if self.reload_timer == 0:
+            self.reload_timer = GLib.timeout_add(GROUPS_RELOAD_DELAY, self.reload)
+
+    def reload(self):
+        self.reload_timer = 0
+        if self.load():
+            self.emit("changed")
+        return False
+
+    def get_group_names(self):
+        return sorted(self.gids.keys())
+
+    def get_gid(self, group):
+        return self.gids.get(group)
+
+    def get_members(self, group):
+        return self.members.get(group, set())
+
+    def get_groups_of_user(self, user_name):
+        return self.user_groups.get(user_name, set())
+
+# Replace the supplementary groups of a user with a single usermod call,
+# which updates /etc/group and /etc/gshadow together (blocking).
+# Return an error message, or None.
+def set_supplementary_groups(user_name, groups):
+    try:
+        result = subprocess.run(["usermod", "-G", ",".join(sorted(groups)), user_name], capture_output=True, text=True)
+    except OSError as e:
+        return str(e)
+    if result.returncode != 0:
+        return result.stderr.strip() or f"usermod exited with status {result.returncode}"
+    return None
+
+group_index = None
+
+def get_group_index():
+    global group_index
+    if group_index is None:
+        group_index = GroupIndex()
+    return group_index
+
+# Return the names of the groups of each user, primary group first
+def get_user_groups():
+    group_names = {}
+    user_groups = {}
+    for group in grp.getgrall():
+        group_names[group.gr_gid] = group.gr_name
+        for member in group.gr_mem:
+            user_groups.setdefault(member, []).append(group.gr_name)
+    for entry in pwd.getpwall():
+        primary = group_names.get(entry.pw_gid)
+        groups = user_groups.setdefault(entry.pw_name, [])
+        if primary is not None and primary not in groups:
+            groups.insert(0, primary)
+    return user_groups
+
+# Case-folded and normalized text, so e.g. "É" typed with a dead key
+# matches a precomposed "é"
+def get_match_key(text):
+    return unicodedata.normalize("NFKC", text.casefold())
+
+# Substring search over a few text fields per item.
+# The fields are normalized and joined once per item, and the matches of
+# the current query are kept: typing more characters only narrows them
+# down, and items which are added or changed are matched on their own.
+class SearchIndex():
+
+    def __init__(self):
+        self.texts = {} # item -> searchable text
+        self.query = ""
+        self.matches = None # Items matching the query, None when not computed yet
+
+    def set(self, item, fields):
+        text = "\n".join(get_match_key(field) for field in fields if field)
+        self.texts[item] = text
+        if self.matches is not None:
+            if self.query in text:
+                self.matches.add(item)
+            else:
+                self.matches.discard(item)
+
+    def remove(self, item):
+        self.texts.pop(item, None)
+        if self.matches is not None:
+            self.matches.discard(item)
+
+    def set_query(self, query):
+        query = get_match_key(query.strip())
+        if query == self.query:
+            return
+        if self.matches is not None and self.query != "" and query.startswith(self.query):
+            self.matches = {item for item in self.matches if query in self.texts[item]}
+        else:
+            self.matches = None
+        self.query = query
+
+    def is_match(self, item):
+        if self.query == "":
+            return True
+        if self.matches is None:
+            self.matches = {item for (item, text) in self.texts.items() if self.query in text}
+        return item in self.matches
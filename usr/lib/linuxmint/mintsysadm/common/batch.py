@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+import xapp.threading as xt
+import xapp.util
+from common.shadow import expire_passwords
+from gi.repository import Gio, GLib, GObject
+
+_ = xapp.util.l10n("mintsysadm")
+
+ACCOUNTS_BUS_NAME = "org.freedesktop.Accounts"
+ACCOUNTS_USER_INTERFACE = "org.freedesktop.Accounts.User"
+
+# A change applied to several users at once
+class UserBatch(GObject.Object):
+    __gsignals__ = {
+        'progress': (GObject.SignalFlags.RUN_FIRST, None, (int, int)),
+        'finished': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    ACTION_ADMINISTRATOR = "administrator"
+    ACTION_STANDARD = "standard"
+    ACTION_RESET_AVATAR = "reset-avatar"
+    ACTION_EXPIRE_PASSWORD = "expire-password"
+
+    def __init__(self, action, users):
+        super(UserBatch, self).__init__()
+        self.action = action
+        self.users = list(users)
+        self.succeeded = [] # usernames
+        self.failed = [] # (username, error message)
+        self.pending = 0
+
+    def start(self):
+        if len(self.users) == 0:
+            self.emit("finished")
+        elif self.action == self.ACTION_EXPIRE_PASSWORD:
+            # AccountsService can only do that by removing the password
+            self.expire_passwords([user.get_user_name() for user in self.users])
+        else:
+            Gio.bus_get(Gio.BusType.SYSTEM, None, self.on_bus_ready)
+
+    def get_call(self):
+        if self.action == self.ACTION_ADMINISTRATOR:
+            return ("SetAccountType", GLib.Variant("(i)", (1,)))
+        elif self.action == self.ACTION_STANDARD:
+            return ("SetAccountType", GLib.Variant("(i)", (0,)))
+        else:
+            return ("SetIconFile", GLib.Variant("(s)", ("",)))
+
+    # All the calls are sent at once, AccountsService answers them as it goes
+    def on_bus_ready(self, source, result):
+        try:
+            connection = Gio.bus_get_finish(result)
+        except GLib.Error as e:
+            self.failed = [(user.get_user_name(), e.message) for user in self.users]
+            self.emit("finished")
+            return
+        method, parameters = self.get_call()
+        self.pending = len(self.users)
+        for user in self.users:
+            connection.call(ACCOUNTS_BUS_NAME, user.get_object_path(), ACCOUNTS_USER_INTERFACE,
+                            method, parameters, None, Gio.DBusCallFlags.ALLOW_INTERACTIVE_AUTHORIZATION,
+                            -1, None, self.on_call_done, user.get_user_name())
+
+    def on_call_done(self, connection, result, user_name):
+        try:
+            connection.call_finish(result)
+            self.succeeded.append(user_name)
+        except GLib.Error as e:
+            Gio.DBusError.strip_remote_error(e)
+            print(f"Unable to update user '{user_name}': {e.message}")
+            self.failed.append((user_name, e.message))
+        self.pending -= 1
+        self.emit("progress", len(self.succeeded) + len(self.failed), len(self.users))
+        if self.pending == 0:
+            self.emit("finished")
+
+    @xt.run_async
+    def expire_passwords(self, user_names):
+        try:
+            missing = expire_passwords(user_names)
+            error = None
+        except OSError as e:
+            print(f"Unable to expire passwords: {e}")
+            missing = set(user_names)
+            error = str(e)
+        self.finish_expiration(user_names, missing, error)
+
+    @xt.run_idle
+    def finish_expiration(self, user_names, missing, error):
+        for user_name in user_names:
+            if user_name in missing:
+                self.failed.append((user_name, error or _("Not a local account")))
+            else:
+                self.succeeded.append(user_name)
+        self.emit("progress", len(user_names), len(user_names))
+        self.emit("finished")
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+import collections
+import gi
+import os
+import xapp.threading as xt
+gi.require_version("AccountsService", "1.0")
+from common.diskusage import disk_usage_scanner, get_disk_usage_monitor
+from gi.repository import AccountsService, GLib, GObject
+
+PROGRESS_INTERVAL = 500 # ms
+
+# The removal of a user and their files
+class DeletionJob():
+
+    STATE_QUEUED = "queued"
+    STATE_DELETING = "deleting"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+
+    def __init__(self, user):
+        self.user = user
+        self.username = user.get_user_name()
+        self.home_dir = user.get_home_dir()
+        # The home directory itself is gone at the end, measure the space on its parent
+        self.home_parent = os.path.dirname(self.home_dir.rstrip("/")) or "/"
+        self.size = None # Disk usage of the home directory, None until it's scanned
+        self.free_at_start = 0
+        self.progress = 0.0
+        self.state = self.STATE_QUEUED
+        self.error = None
+
+    def is_active(self):
+        return self.state in (self.STATE_QUEUED, self.STATE_DELETING)
+
+# Removes users one at a time with the asynchronous AccountsService API.
+# The progress of a removal is estimated from the space freed on the disk,
+# so a removal only starts once the size of its home directory is known:
+# the size shown in the UI is used if there's one, otherwise the home
+# directory is measured as soon as its user is queued.
+class DeletionJobs(GObject.Object):
+    __gsignals__ = {
+        'job-changed': (GObject.SignalFlags.RUN_FIRST, None, (object,))
+    }
+
+    def __init__(self):
+        super(DeletionJobs, self).__init__()
+        self.manager = AccountsService.UserManager.get_default()
+        self.jobs = {} # username -> queued or running job
+        self.queue = collections.deque()
+        self.current = None
+        self.progress_timer = 0
+
+    def add(self, user):
+        job = DeletionJob(user)
+        job.size = get_disk_usage_monitor().get_known_usage(job.home_dir)
+        self.jobs[job.username] = job
+        self.queue.append(job)
+        self.emit("job-changed", job)
+        if job.size is None:
+            self.scan_home(job)
+        else:
+            self.start_next()
+        return job
+
+    def get_job(self, username):
+        return self.jobs.get(username)
+
+    def is_deleting(self, username):
+        job = self.jobs.get(username)
+        return job is not None and job.is_active()
+
+    @xt.run_async
+    def scan_home(self, job):
+        size = disk_usage_scanner.scan(job.home_dir, remember=False) if os.path.isdir(job.home_dir) else 0
+        self.set_home_size(job, size)
+
+    @xt.run_idle
+    def set_home_size(self, job, size):
+        job.size = size
+        self.emit("job-changed", job)
+        self.start_next()
+
+    def get_free_space(self, path):
+        try:
+            stat_info = os.statvfs(path)
+        except OSError:
+            return 0
+        return stat_info.f_bavail * stat_info.f_frsize
+
+    def start_next(self):
+        if self.current is not None or len(self.queue) == 0 or self.queue[0].size is None:
+            return
+        job = self.queue.popleft()
+        self.current = job
+        job.state = DeletionJob.STATE_DELETING
+        job.free_at_start = self.get_free_space(job.home_parent)
+        self.emit("job-changed", job)
+        self.progress_timer = GLib.timeout_add(PROGRESS_INTERVAL, self.update_progress)
+        self.manager.delete_user_async(job.user, True, None, self.on_user_deleted, job)
+
+    def update_progress(self):
+        job = self.current
+        if job.size:
+            freed = self.get_free_space(job.home_parent) - job.free_at_start
+            progress = max(0.0, min(0.99, freed / job.size))
+            if progress != job.progress:
+                job.progress = progress
+                self.emit("job-changed", job)
+        return True
+
+    def on_user_deleted(self, manager, result, job):
+        GLib.source_remove(self.progress_timer)
+        self.progress_timer = 0
+        self.current = None
+        try:
+            manager.delete_user_finish(result)
+            job.state = DeletionJob.STATE_DONE
+            job.progress = 1.0
+            get_disk_usage_monitor().forget(job.home_dir)
+        except GLib.Error as e:
+            print(f"Unable to remove user '{job.username}': {e.message}")
+            job.state = DeletionJob.STATE_FAILED
+            job.error = e.message
+        if self.jobs.get(job.username) is job:
+            del self.jobs[job.username]
+        self.emit("job-changed", job)
+        self.start_next()
+
+deletion_jobs = None
+
+def get_deletion_jobs():
+    global deletion_jobs
+    if deletion_jobs is None:
+        deletion_jobs = DeletionJobs()
+    return deletion_jobs
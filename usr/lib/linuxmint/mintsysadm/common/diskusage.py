@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+import collections
+import ctypes
+import json
+import os
+import platform
+import queue
+import threading
+import time
+import xapp.threading as xt
+from gi.repository import GLib, GObject
+
+DISK_USAGE_INDEX_PATH = os.path.join(GLib.get_user_cache_dir(), "mintsysadm", "disk-usage.json")
+DISK_USAGE_THREADS = 4
+RESULT_MAX_AGE = 600 # seconds, homes shown for longer than that are scanned again
+DIRECTORY_MAX_AGE = RESULT_MAX_AGE # seconds, unchanged directories are listed again after that
+
+# ioprio_set() has no wrapper in Python or glibc
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30, "armv7l": 314, "ppc64le": 273}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Lower the CPU and I/O priorities of the calling thread, so scans only use
+# the disk when nothing else needs it.
+def set_background_priority():
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except OSError:
+        pass
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        except (OSError, AttributeError):
+            pass
+
+# Measures the disk usage of directory trees with a pool of os.scandir() workers.
+# A small on-disk index keeps, for each tree, the size of every top-level
+# directory with its inode and mtime: top-level directories which didn't
+# change since the previous scan aren't walked again. Changes deeper in the
+# tree don't touch their mtime, so indexed sizes expire as soon as results
+# shown in the UI do, the index mostly saves walking homes again on startup.
+class DiskUsageScanner():
+
+    def __init__(self, index_path=DISK_USAGE_INDEX_PATH, num_threads=DISK_USAGE_THREADS):
+        self.index_path = index_path
+        self.num_threads = num_threads
+        self.lock = threading.Lock()
+        self.index = None # root -> {"size": total, "time": scan time, "directories": {name: [inode, mtime, size, scan time]}}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as index_file:
+                self.index = json.load(index_file)
+        except (OSError, ValueError):
+            self.index = {}
+        if not isinstance(self.index, dict):
+            self.index = {}
+
+    # Write the index if scans changed it
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.index)
+            self.dirty = False
+        temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_native_id()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(temp_path, "w") as index_file:
+                index_file.write(data)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Unable to save disk usage index: {e}")
+
+    # Return the disk usage of a directory tree in bytes (blocking, call it from a thread).
+    # Symlinks aren't followed and other filesystems mounted in the tree aren't counted.
+    # The result is kept in the index (in memory until save() is called) if remember is True.
+    def scan(self, root, remember=True):
+        with self.lock:
+            if self.index is None:
+                self.load()
+            record = self.index.get(root)
+        previous = record.get("directories") if isinstance(record, dict) else None
+        if not isinstance(previous, dict):
+            previous = {}
+        try:
+            root_device = os.stat(root, follow_symlinks=False).st_dev
+        except OSError:
+            return 0
+
+        now = time.time()
+        total, names = self.scan_directory(root, root_device)
+        directories = {} # name -> [inode, mtime, size, scan time]
+        totals = {} # name -> size, for the directories to walk
+        pending = queue.Queue()
+        for name in names:
+            try:
+                stat_info = os.stat(os.path.join(root, name), follow_symlinks=False)
+            except OSError:
+                continue
+            if stat_info.st_dev != root_device:
+                continue
+            cached = previous.get(name)
+            if self.is_fresh(cached, stat_info, now):
+                directories[name] = cached
+            else:
+                directories[name] = [stat_info.st_ino, stat_info.st_mtime_ns, 0, now]
+                totals[name] = 0
+                pending.put((name, name))
+
+        state = {"outstanding": len(totals)}
+        state_lock = threading.Lock()
+        done = threading.Event()
+
+        def work():
+            set_background_priority()
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                top, relative = item
+                try:
+                    size, subdirectories = self.scan_directory(os.path.join(root, relative), root_device)
+                    with state_lock:
+                        totals[top] += size
+                        state["outstanding"] += len(subdirectories)
+                        for name in subdirectories:
+                            pending.put((top, os.path.join(relative, name)))
+                except Exception as e:
+                    print(f"Unable to measure '{os.path.join(root, relative)}': {e}")
+                finally:
+                    # Always account for the directory, or the scan would never end
+                    with state_lock:
+                        state["outstanding"] -= 1
+                        if state["outstanding"] == 0:
+                            done.set()
+
+        if len(totals) > 0:
+            threads = [threading.Thread(target=work, daemon=True) for i in range(self.num_threads)]
+            for thread in threads:
+                thread.start()
+            done.wait()
+            for thread in threads:
+                pending.put(None)
+
+        for name, size in totals.items():
+            directories[name][2] = size
+        total += sum(entry[2] for entry in directories.values())
+        if remember:
+            with self.lock:
+                self.index[root] = {"size": total, "time": now, "directories": directories}
+                self.dirty = True
+        return total
+
+    # Drop a tree from the index, e.g. once it was removed
+    def forget(self, root):
+        with self.lock:
+            if self.index is None:
+                self.load()
+            if self.index.pop(root, None) is not None:
+                self.dirty = True
+        self.save()
+
+    def is_fresh(self, cached, stat_info, now):
+        try:
+            return cached[0] == stat_info.st_ino and cached[1] == stat_info.st_mtime_ns and now - cached[3] < DIRECTORY_MAX_AGE and cached[2] >= 0
+        except (TypeError, IndexError, KeyError):
+            return False
+
+    # Return the size of a directory and of the files directly in it, and its subdirectories
+    def scan_directory(self, path, root_device):
+        try:
+            stat_info = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return (0, [])
+        if stat_info.st_dev != root_device:
+            return (0, [])
+        size = stat_info.st_blocks * 512
+        subdirectories = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.name)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return (size, subdirectories)
+
+disk_usage_scanner = DiskUsageScanner()
+
+# Disk usage of home directories for the UI. Homes are scanned one at a time
+# in a thread, the most recently requested first (i.e. the cards which just
+# scrolled into view), and the results are announced with 'usage-changed'.
+class DiskUsageMonitor(GObject.Object):
+    __gsignals__ = {
+        'usage-changed': (GObject.SignalFlags.RUN_FIRST, None, (str,))
+    }
+
+    def __init__(self, scanner=disk_usage_scanner):
+        super(DiskUsageMonitor, self).__init__()
+        self.scanner = scanner
+        self.results = {} # path -> (size, time of the scan)
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict() # paths to scan, most recent last
+        self.requested = set() # paths pending or being scanned
+        self.thread = None
+
+    # Return the last known size of a directory, or None.
+    # A scan is requested if there's no result yet, or if it's outdated.
+    def get_usage(self, path):
+        result = self.results.get(path)
+        if result is None or time.time() - result[1] > RESULT_MAX_AGE:
+            self.request(path)
+        return result[0] if result is not None else None
+
+    # Return the last known size of a directory, however old, or None.
+    # Unlike get_usage(), this never requests a scan.
+    def get_known_usage(self, path):
+        result = self.results.get(path)
+        return result[0] if result is not None else None
+
+    def request(self, path):
+        with self.condition:
+            if path in self.requested and path not in self.pending:
+                return # Being scanned
+            self.requested.add(path)
+            self.pending[path] = True
+            self.pending.move_to_end(path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                path, unused = self.pending.popitem(last=True)
+            if os.path.isdir(path):
+                size = self.scanner.scan(path)
+            else:
+                size = 0
+            self.set_usage(path, size)
+            # Save the index once all the requested homes are measured
+            with self.condition:
+                finished = len(self.pending) == 0
+            if finished:
+                self.scanner.save()
+
+    # Drop the size of a directory which was removed, from the index too
+    def forget(self, path):
+        with self.condition:
+            self.pending.pop(path, None)
+            self.requested.discard(path)
+        self.results.pop(path, None)
+        self.forget_index(path)
+
+    @xt.run_async
+    def forget_index(self, path):
+        self.scanner.forget(path)
+
+    @xt.run_idle
+    def set_usage(self, path, size):
+        with self.condition:
+            forgotten = path not in self.requested
+            self.requested.discard(path)
+        if forgotten:
+            # Forgotten while it was scanned
+            self.forget_index(path)
+            return
+        self.results[path] = (size, time.time())
+        self.emit("usage-changed", path)
+
+disk_usage_monitor = None
+
+def get_disk_usage_monitor():
+    global disk_usage_monitor
+    if disk_usage_monitor is None:
+        disk_usage_monitor = DiskUsageMonitor()
+    return disk_usage_monitor
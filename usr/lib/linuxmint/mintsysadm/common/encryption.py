@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+import collections
+import configparser
+import glob
+import os
+import shutil
+import subprocess
+import xapp.threading as xt
+from gi.repository import GObject
+
+USERS_CONFIG = "/etc/mintsysadm/users.conf"
+
+# How many home directories can be encrypted at the same time.
+# The default can be changed in the [encryption] section of USERS_CONFIG, e.g.
+#   max-parallel-jobs=4
+def get_max_parallel_encryptions(path=USERS_CONFIG):
+    config = configparser.ConfigParser()
+    try:
+        config.read(path)
+        if config.has_section("encryption"):
+            return max(1, int(config["encryption"].get("max-parallel-jobs", 2)))
+    except (configparser.Error, ValueError) as e:
+        print(f"Invalid encryption configuration: {e}")
+    return 2
+
+# The encryption of the home directory of a new user
+class EncryptionJob():
+
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+
+    def __init__(self, username, uid, password):
+        self.username = username
+        self.uid = uid
+        self.password = password # Forgotten once handed to ecryptfs-migrate-home
+        self.state = self.STATE_QUEUED
+        self.last_line = "" # Last line of output, as progress
+        self.output = []
+
+    def is_active(self):
+        return self.state in (self.STATE_QUEUED, self.STATE_RUNNING)
+
+# Runs ecryptfs-migrate-home in threads, a limited number at a time,
+# streaming the output of each job back to the main thread.
+class EncryptionJobs(GObject.Object):
+    __gsignals__ = {
+        'job-changed': (GObject.SignalFlags.RUN_FIRST, None, (object,))
+    }
+
+    def __init__(self, max_parallel=None):
+        super(EncryptionJobs, self).__init__()
+        self.max_parallel = max_parallel if max_parallel is not None else get_max_parallel_encryptions()
+        self.jobs = {} # username -> latest job
+        self.queue = collections.deque()
+        self.running = 0
+
+    def add(self, username, uid, password):
+        job = EncryptionJob(username, uid, password)
+        self.jobs[username] = job
+        self.queue.append(job)
+        self.emit("job-changed", job)
+        self.start_jobs()
+        return job
+
+    def get_job(self, username):
+        return self.jobs.get(username)
+
+    def is_encrypting(self, username):
+        job = self.jobs.get(username)
+        return job is not None and job.is_active()
+
+    def start_jobs(self):
+        while self.running < self.max_parallel and len(self.queue) > 0:
+            job = self.queue.popleft()
+            job.state = EncryptionJob.STATE_RUNNING
+            self.running += 1
+            self.emit("job-changed", job)
+            self.run_job(job, job.password)
+            job.password = None
+
+    @xt.run_async
+    def run_job(self, job, password):
+        try:
+            # Pass the password through stdin, not the command line
+            proc = subprocess.Popen(["ecryptfs-migrate-home", "-u", job.username],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    text=True, errors="replace")
+            proc.stdin.write(password)
+            proc.stdin.close()
+            for line in proc.stdout:
+                line = line.strip()
+                if line != "":
+                    self.report_output(job, line)
+            success = proc.wait() == 0
+        except OSError as e:
+            self.report_output(job, str(e))
+            success = False
+        if success:
+            self.remove_backups(job)
+        self.finish_job(job, success)
+
+    # The original home directory is kept as a backup, it's useless for a new user
+    def remove_backups(self, job):
+        for backup_dir in glob.glob(f"/home/{glob.escape(job.username)}.[A-Za-z0-9]*"):
+            try:
+                # Verify the directory is owned by the user before deleting
+                if os.path.isdir(backup_dir) and not os.path.islink(backup_dir) and os.stat(backup_dir).st_uid == job.uid:
+                    shutil.rmtree(backup_dir)
+            except OSError as e:
+                print(f"Unable to remove backup directory '{backup_dir}': {e}")
+
+    @xt.run_idle
+    def report_output(self, job, line):
+        job.output.append(line)
+        job.last_line = line
+        self.emit("job-changed", job)
+
+    @xt.run_idle
+    def finish_job(self, job, success):
+        self.running -= 1
+        if success:
+            job.state = EncryptionJob.STATE_DONE
+        else:
+            job.state = EncryptionJob.STATE_FAILED
+            print(f"Unable to encrypt the home directory of '{job.username}':")
+            print("\n".join(job.output))
+        self.emit("job-changed", job)
+        self.start_jobs()
+
+encryption_jobs = None
+
+def get_encryption_jobs():
+    global encryption_jobs
+    if encryption_jobs is None:
+        encryption_jobs = EncryptionJobs()
+    return encryption_jobs
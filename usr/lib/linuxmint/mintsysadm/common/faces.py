@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+import json
+import os
+import re
+from gi.repository import Gio, GLib, GObject
+
+DEFAULT_FACE_DIRS = ["/usr/share/pixmaps/faces/linuxmint"]
+# Additional face directories, one per line
+FACE_DIRS_CONFIG = "/etc/mintsysadm/face-dirs"
+FACE_INDEX_PATH = os.path.join(GLib.get_user_cache_dir(), "mintsysadm", "faces.json")
+FACE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+RESCAN_DELAY = 500 # ms
+
+def get_face_dirs():
+    face_dirs = list(DEFAULT_FACE_DIRS)
+    try:
+        with open(FACE_DIRS_CONFIG, "r", errors="replace") as config_file:
+            for line in config_file:
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                face_dir = os.path.normpath(line)
+                if face_dir not in face_dirs:
+                    face_dirs.append(face_dir)
+    except OSError:
+        pass
+    return face_dirs
+
+# "110_book.jpg" -> "book"
+def get_face_label(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    name = re.sub(r"^\d+[_-]", "", name)
+    return name.replace("_", " ").replace("-", " ")
+
+# An index of the pictures found in the face directories.
+# Directory listings are persisted along with the directory mtimes, so
+# unchanged directories aren't scanned again, and each directory is
+# monitored so the index stays current while the application runs.
+class FaceLibrary(GObject.Object):
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self, face_dirs=None, index_path=FACE_INDEX_PATH):
+        super(FaceLibrary, self).__init__()
+        self.face_dirs = face_dirs if face_dirs is not None else get_face_dirs()
+        self.index_path = index_path
+        self.listings = {} # face_dir -> {"mtime": ..., "faces": [...]}
+        self.faces = [] # (path, search key) pairs, in display order
+        self.monitors = []
+        self.rescan_timers = {}
+        self.load()
+        self.start_monitoring()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            index = {}
+        dirty = False
+        for face_dir in self.face_dirs:
+            listing = index.get(face_dir)
+            mtime = self.get_mtime(face_dir)
+            if listing is None or listing.get("mtime") != mtime:
+                listing = self.scan(face_dir, mtime)
+                dirty = True
+            self.listings[face_dir] = listing
+        if dirty:
+            self.save()
+        self.update_faces()
+
+    def get_mtime(self, face_dir):
+        try:
+            return os.stat(face_dir).st_mtime_ns
+        except OSError:
+            return None
+
+    def scan(self, face_dir, mtime):
+        faces = []
+        if mtime is not None:
+            try:
+                with os.scandir(face_dir) as it:
+                    for entry in it:
+                        if entry.name.lower().endswith(FACE_EXTENSIONS) and entry.is_file():
+                            faces.append(entry.name)
+            except OSError as e:
+                print(f"Unable to scan face directory '{face_dir}': {e}")
+        faces.sort()
+        return {"mtime": mtime, "faces": faces}
+
+    def save(self):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(temp_path, "w") as index_file:
+                json.dump(self.listings, index_file)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Unable to save face index: {e}")
+
+    def update_faces(self):
+        self.faces = []
+        for face_dir in self.face_dirs:
+            for name in self.listings[face_dir]["faces"]:
+                path = os.path.join(face_dir, name)
+                key = f"{get_face_label(name)} {name}".lower()
+                self.faces.append((path, key))
+
+    # Return the paths of the faces matching the text
+    def search(self, text):
+        text = text.strip().lower()
+        if text == "":
+            return [path for (path, key) in self.faces]
+        return [path for (path, key) in self.faces if text in key]
+
+    def start_monitoring(self):
+        for face_dir in self.face_dirs:
+            try:
+                monitor = Gio.File.new_for_path(face_dir).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as e:
+                print(f"Unable to monitor face directory '{face_dir}': {e.message}")
+                continue
+            monitor.connect("changed", self.on_face_dir_changed, face_dir)
+            self.monitors.append(monitor)
+
+    def on_face_dir_changed(self, monitor, file, other_file, event_type, face_dir):
+        # Coalesce bursts of events (e.g. a package unpacking lots of faces)
+        if face_dir not in self.rescan_timers:
+            self.rescan_timers[face_dir] = GLib.timeout_add(RESCAN_DELAY, self.rescan, face_dir)
+
+    def rescan(self, face_dir):
+        del self.rescan_timers[face_dir]
+        listing = self.scan(face_dir, self.get_mtime(face_dir))
+        if listing != self.listings[face_dir]:
+            self.listings[face_dir] = listing
+            self.save()
+            self.update_faces()
+            self.emit("changed")
+        return False
+
+face_library = None
+
+# The library is only created when a picker needs it, so it costs nothing at startup
+def get_face_library():
+    global face_library
+    if face_library is None:
+        face_library = FaceLibrary()
+    return face_library
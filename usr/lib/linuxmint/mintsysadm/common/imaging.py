@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+from PIL import ImageOps
+
+# Modes Image.reduce() works with, others raise "image has wrong mode"
+REDUCIBLE_MODES = ("RGB", "RGBA", "L", "LA")
+
+# RGBA if the picture has any transparency (alpha band or transparent palette entry)
+def get_rgb_mode(pil_image):
+    if "A" in pil_image.getbands() or "transparency" in pil_image.info:
+        return "RGBA"
+    return "RGB"
+
+# Shrink a decoded picture by the largest integer factor which keeps its
+# smaller side at least size pixels, apply its EXIF orientation and return
+# it in RGB or RGBA. Reducing first is much cheaper than LANCZOS on the full
+# image, palette, 1-bit and 16-bit pictures are converted before that.
+def reduce_image(pil_image, size):
+    if pil_image.mode not in REDUCIBLE_MODES:
+        rgb_mode = get_rgb_mode(pil_image)
+        print(f"Converting image from mode {pil_image.mode} to {rgb_mode}")
+        pil_image = pil_image.convert(rgb_mode)
+    factor = min(pil_image.size) // size
+    if factor >= 2:
+        pil_image = pil_image.reduce(factor)
+    pil_image = ImageOps.exif_transpose(pil_image)
+    if pil_image.mode not in ("RGB", "RGBA"):
+        pil_image = pil_image.convert(get_rgb_mode(pil_image))
+    return pil_image
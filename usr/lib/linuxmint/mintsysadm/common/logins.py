@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+import mmap
+import os
+import struct
+import threading
+
+WTMP_PATH = "/var/log/wtmp"
+BTMP_PATH = "/var/log/btmp"
+
+# struct utmp, see utmp(5)
+UTMP_STRUCT = struct.Struct("<h2xi32s4s32s256shhiii16s20x")
+UTMP_RUN_LVL = 1
+UTMP_BOOT_TIME = 2
+UTMP_USER_PROCESS = 7
+UTMP_DEAD_PROCESS = 8
+SCAN_CHUNK = 4096 # records scanned before checking if enough were found
+
+def decode_field(value):
+    return value.split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+# A login, or a failed login attempt. Only the offset and times are kept
+# in the index, the terminal and host are read from the log when needed.
+class LoginSession():
+
+    END_LOGOUT = "logout"
+    END_CRASH = "crash" # The system went down without a logout record
+    END_DOWN = "down" # Shut down
+    END_ACTIVE = "active" # Still logged in
+    END_FAILED = "failed" # Failed attempt (btmp)
+
+    def __init__(self, offset, login_time, logout_time, end):
+        self.offset = offset
+        self.login_time = login_time
+        self.logout_time = logout_time
+        self.end = end
+        self.line = None
+        self.host = None
+
+# Reads a wtmp or btmp file through mmap, from the end of the file backwards.
+# Records are decoded with a precompiled struct, only as far back as needed
+# to fill the requested page, and every login met on the way is added to a
+# per-user index, so other users are served from the part already read.
+# Records appended to the log are indexed on their own, the index is only
+# dropped if the log is rotated or truncated.
+class LoginLog():
+
+    def __init__(self, path, failures=False):
+        self.path = path
+        self.failures = failures # btmp: every record is a failed attempt
+        self.lock = threading.Lock()
+        self.identity = None
+        self.map = None
+        self.reset()
+
+    def reset(self):
+        self.position = 0 # Number of records not scanned yet, from the start of the file
+        self.sessions = {} # username -> sessions, most recent first
+        self.pending_logouts = {} # line -> (time, end) of a logout not matched with its login yet
+        self.next_boot = None # (time, end) of the earliest boot or shutdown scanned so far
+        self.active = {} # line -> sessions without a logout yet, most recent first
+        self.lines = set() # Lines of the records scanned, until a boot is met
+
+    def open(self):
+        try:
+            stat_info = os.stat(self.path)
+        except OSError as e:
+            print(f"Unable to read '{self.path}': {e}")
+            self.close()
+            return False
+        identity = (stat_info.st_dev, stat_info.st_ino)
+        if identity == self.identity and self.map is not None:
+            if stat_info.st_size == len(self.map):
+                return True
+            if stat_info.st_size > len(self.map):
+                return self.map_tail()
+        self.close()
+        self.identity = identity
+        if stat_info.st_size < UTMP_STRUCT.size:
+            return True
+        self.map = self.map_file()
+        if self.map is None:
+            return False
+        self.position = len(self.map) // UTMP_STRUCT.size
+        return True
+
+    def map_file(self):
+        try:
+            with open(self.path, "rb") as log_file:
+                return mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            print(f"Unable to map '{self.path}': {e}")
+            return None
+
+    # The log grew, map it again and index the new records
+    def map_tail(self):
+        log_map = self.map_file()
+        if log_map is None:
+            self.close()
+            return False
+        first = len(self.map) // UTMP_STRUCT.size
+        self.map.close()
+        self.map = log_map
+        self.scan_tail(first, len(self.map) // UTMP_STRUCT.size)
+        return True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.identity = None
+        self.reset()
+
+    # Return up to count sessions of a user older than the one at the offset
+    # before (or the most recent ones if it's None), most recent first, and
+    # whether there are more (blocking, call it from a thread).
+    # Offsets don't move when records are appended, so pages don't overlap.
+    def get_sessions(self, user_name, before, count):
+        with self.lock:
+            if not self.open():
+                return ([], False)
+            sessions = self.sessions.setdefault(user_name, [])
+            # Scanning further only adds older sessions after these
+            start = self.find_older(sessions, before)
+            while len(sessions) < start + count and self.position > 0:
+                self.scan(SCAN_CHUNK)
+            page = sessions[start:start + count]
+            for session in page:
+                self.read_details(session)
+            more = len(sessions) > start + count or self.position > 0
+            return (page, more)
+
+    # Index of the first session older than the one at the offset before
+    def find_older(self, sessions, before):
+        if before is None:
+            return 0
+        low = 0
+        high = len(sessions)
+        while low < high:
+            middle = (low + high) // 2
+            if sessions[middle].offset >= before:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def scan(self, num_records):
+        end = self.position
+        self.position = max(0, end - num_records)
+        self.next_boot = self.scan_records(self.position, end, self.pending_logouts, self.next_boot,
+                                           self.active, self.add_session)
+
+    # Index the records from first to end, which were appended after the
+    # ones already scanned: their sessions are newer than all the others,
+    # and their logouts and boots end sessions which were still active.
+    def scan_tail(self, first, end):
+        new_sessions = {}
+        def add_new_session(user, session):
+            new_sessions.setdefault(decode_field(user), []).append(session)
+        logouts = {}
+        new_active = {}
+        old_lines = self.lines
+        self.lines = set()
+        boot = self.scan_records(first, end, logouts, None, new_active, add_new_session)
+        new_lines = self.lines
+        self.lines = old_lines
+        for user_name, sessions in new_sessions.items():
+            self.sessions[user_name] = sessions + self.sessions.get(user_name, [])
+        # The most recent active session of a line gets the logout left over
+        # on it, any of them gets the boot
+        for line, sessions in list(self.active.items()):
+            if line in logouts:
+                self.end_session(sessions.pop(0), logouts.pop(line))
+            if boot is not None:
+                for session in sessions:
+                    self.end_session(session, boot)
+                sessions.clear()
+        for line, sessions in new_active.items():
+            self.active[line] = sessions + self.active.get(line, [])
+        self.active = {line: sessions for (line, sessions) in self.active.items() if sessions}
+        # Older records are only affected through lines not used since then
+        if self.next_boot is None:
+            for line, logout in logouts.items():
+                if line not in self.lines:
+                    self.pending_logouts[line] = logout
+            self.lines.update(new_lines)
+            self.next_boot = boot
+
+    def end_session(self, session, logout):
+        session.logout_time = logout[0]
+        session.end = logout[1]
+
+    # Scan records backwards, matching logins with the logouts and boot which
+    # followed them, return the earliest boot
+    def scan_records(self, first, end, logouts, boot, active, add_session):
+        unpack_from = UTMP_STRUCT.unpack_from
+        for index in range(end - 1, first - 1, -1):
+            offset = index * UTMP_STRUCT.size
+            (ut_type, pid, line, ut_id, user, host, termination, exit_status, session,
+             seconds, microseconds, address) = unpack_from(self.map, offset)
+            if self.failures:
+                if user[0] != 0:
+                    add_session(user, LoginSession(offset, seconds, None, LoginSession.END_FAILED))
+                continue
+            if boot is None and ut_type in (UTMP_USER_PROCESS, UTMP_DEAD_PROCESS):
+                self.lines.add(line)
+            if ut_type == UTMP_USER_PROCESS and user[0] != 0:
+                logout = logouts.pop(line, None)
+                if logout is None:
+                    logout = boot if boot is not None else (None, LoginSession.END_ACTIVE)
+                login_session = LoginSession(offset, seconds, logout[0], logout[1])
+                if login_session.end == LoginSession.END_ACTIVE:
+                    active.setdefault(line, []).append(login_session)
+                add_session(user, login_session)
+            elif ut_type == UTMP_DEAD_PROCESS:
+                logouts[line] = (seconds, LoginSession.END_LOGOUT)
+            elif ut_type == UTMP_BOOT_TIME or (ut_type == UTMP_RUN_LVL and user.startswith(b"shutdown\0")):
+                # Sessions still open before this point ended with it
+                end_type = LoginSession.END_CRASH if ut_type == UTMP_BOOT_TIME else LoginSession.END_DOWN
+                boot = (seconds, end_type)
+                logouts.clear()
+        return boot
+
+    def add_session(self, user, session):
+        user_name = decode_field(user)
+        sessions = self.sessions.get(user_name)
+        if sessions is None:
+            sessions = self.sessions[user_name] = []
+        sessions.append(session)
+
+    def read_details(self, session):
+        if session.line is None:
+            fields = UTMP_STRUCT.unpack_from(self.map, session.offset)
+            session.line = decode_field(fields[2])
+            session.host = decode_field(fields[5])
+
+wtmp_log = LoginLog(WTMP_PATH)
+btmp_log = LoginLog(BTMP_PATH, failures=True)
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+import collections
+import csv
+import gi
+import json
+import os
+import pwd
+import re
+import subprocess
+import xapp.threading as xt
+import xapp.util
+gi.require_version("AccountsService", "1.0")
+from common.accounts import read_local_groups
+from gi.repository import AccountsService, GLib, GObject
+
+_ = xapp.util.l10n("mintsysadm")
+
+MAX_PARALLEL_CREATIONS = 4
+ADMIN_GROUP = "sudo"
+TRUE_VALUES = ("1", "y", "yes", "true")
+
+# Column names accepted in user files, and the field they fill
+FIELD_NAMES = {
+    "username": "username",
+    "user": "username",
+    "login": "username",
+    "fullname": "fullname",
+    "realname": "fullname",
+    "name": "fullname",
+    "administrator": "administrator",
+    "admin": "administrator",
+    "password": "password",
+    "groups": "groups",
+}
+
+# A user to create, read from a line of a user file
+class UserRecord():
+
+    STATUS_INVALID = "invalid"
+    STATUS_WAITING = "waiting"
+    STATUS_CREATING = "creating"
+    STATUS_CREATED = "created" # Waiting for its groups
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, line, username, fullname, administrator, password, groups):
+        self.line = line
+        self.username = username
+        self.fullname = fullname if fullname != "" else username
+        self.administrator = administrator
+        self.password = password
+        self.groups = groups
+        self.status = self.STATUS_WAITING
+        self.message = ""
+
+    def set_status(self, status, message=""):
+        self.status = status
+        self.message = message
+
+    def get_groups(self):
+        if self.administrator and ADMIN_GROUP not in self.groups:
+            return [ADMIN_GROUP] + self.groups
+        return self.groups
+
+def parse_groups(value):
+    if isinstance(value, list):
+        return [str(group).strip() for group in value if str(group).strip() != ""]
+    return [group for group in re.split(r"[\s,;]+", str(value or "")) if group != ""]
+
+def parse_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in TRUE_VALUES
+
+# "Full Name" -> "fullname"
+def get_field_name(column):
+    return FIELD_NAMES.get(re.sub(r"[\s_-]", "", str(column or "")).lower())
+
+def make_record(line, fields):
+    values = {}
+    for key, value in fields.items():
+        field = get_field_name(key)
+        if field is not None:
+            values[field] = value
+    return UserRecord(line,
+                      str(values.get("username") or "").strip(),
+                      str(values.get("fullname") or "").strip(),
+                      parse_boolean(values.get("administrator")),
+                      str(values.get("password") or ""),
+                      parse_groups(values.get("groups")))
+
+# Read a CSV file (with a header line) or a JSON file (a list of objects).
+# Raises ValueError if the file can't be parsed at all.
+def read_user_file(path):
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as user_file:
+        if path.lower().endswith(".json"):
+            try:
+                entries = json.load(user_file)
+            except ValueError as e:
+                raise ValueError(_("Invalid JSON file: %s") % e)
+            if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+                raise ValueError(_("The JSON file must contain a list of users."))
+            return [make_record(index + 1, entry) for index, entry in enumerate(entries)]
+        reader = csv.DictReader(user_file)
+        if reader.fieldnames is None or not any(get_field_name(name) == "username" for name in reader.fieldnames):
+            raise ValueError(_("The CSV file must start with a header line containing a 'username' column."))
+        return [make_record(reader.line_num, entry) for entry in reader]
+
+# Check all the records before anything is created. known_names are the
+# usernames AccountsService knows about, others are looked up with NSS.
+def validate_records(records, known_names, known_groups):
+    seen = set()
+    for record in records:
+        if record.username == "":
+            record.set_status(UserRecord.STATUS_INVALID, _("No username."))
+        elif re.search('[^a-z0-9_-]', record.username):
+            record.set_status(UserRecord.STATUS_INVALID, _("Invalid username. Only lowercase letters, numbers, hyphens and underscores are allowed."))
+        elif record.username in seen:
+            record.set_status(UserRecord.STATUS_INVALID, _("This username appears more than once."))
+        elif record.username in known_names or user_name_exists(record.username):
+            record.set_status(UserRecord.STATUS_INVALID, _("This username is already taken."))
+        elif record.password != "" and len(record.password) < 8:
+            record.set_status(UserRecord.STATUS_INVALID, _("The password must be at least 8 characters long."))
+        else:
+            unknown_groups = [group for group in record.get_groups() if group not in known_groups]
+            if len(unknown_groups) > 0:
+                record.set_status(UserRecord.STATUS_INVALID, _("Unknown groups: %s") % ", ".join(unknown_groups))
+            else:
+                record.set_status(UserRecord.STATUS_WAITING)
+        seen.add(record.username)
+
+# Write the new credentials of users to a CSV file only root can read, in
+# the format read_user_file() understands. entries are (username, full name, password).
+# The file is replaced atomically, an existing sheet is kept intact on failure.
+def write_credential_sheet(path, entries):
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    # Don't follow links planted at the path, this runs as root
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    try:
+        with open(fd, "w", newline="") as sheet_file:
+            os.fchmod(sheet_file.fileno(), 0o600)
+            writer = csv.writer(sheet_file)
+            writer.writerow(["username", "full name", "password"])
+            writer.writerows(entries)
+            sheet_file.flush()
+            os.fsync(sheet_file.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+def user_name_exists(user_name):
+    try:
+        pwd.getpwnam(user_name)
+        return True
+    except KeyError:
+        return False
+
+# Creates the users of valid records, a few at a time, with the asynchronous
+# AccountsService API so the main loop keeps running. Group memberships are
+# collected and applied at the end, with a single member list update per group.
+class UserProvisioner(GObject.Object):
+    __gsignals__ = {
+        'record-changed': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
+        'finished': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self, records, max_parallel=MAX_PARALLEL_CREATIONS):
+        super(UserProvisioner, self).__init__()
+        self.manager = AccountsService.UserManager.get_default()
+        self.records = [record for record in records if record.status == UserRecord.STATUS_WAITING]
+        self.queue = collections.deque(self.records)
+        self.max_parallel = max_parallel
+        self.running = 0
+        self.cancelled = False
+        self.applying_groups = False
+
+    def start(self):
+        self.fill()
+
+    # Don't start more creations, the running ones still complete
+    def cancel(self):
+        self.cancelled = True
+        self.fill()
+
+    def fill(self):
+        while not self.cancelled and self.running < self.max_parallel and len(self.queue) > 0:
+            self.create(self.queue.popleft())
+        if self.running == 0 and (self.cancelled or len(self.queue) == 0) and not self.applying_groups:
+            self.applying_groups = True
+            self.apply_groups()
+
+    def create(self, record):
+        self.running += 1
+        record.set_status(UserRecord.STATUS_CREATING)
+        self.emit("record-changed", record)
+        if record.administrator:
+            account_type = AccountsService.UserAccountType.ADMINISTRATOR
+        else:
+            account_type = AccountsService.UserAccountType.STANDARD
+        self.manager.create_user_async(record.username, record.fullname, account_type, None, self.on_user_created, record)
+
+    def on_user_created(self, manager, result, record):
+        try:
+            user = manager.create_user_finish(result)
+        except GLib.Error as e:
+            self.running -= 1
+            record.set_status(UserRecord.STATUS_FAILED, e.message)
+            self.emit("record-changed", record)
+            self.fill()
+            return
+        self.set_password(user, record)
+
+    # The password calls of AccountsService are synchronous, make them in a thread
+    @xt.run_async
+    def set_password(self, user, record):
+        if record.password != "":
+            user.set_password(record.password, "")
+            user.set_password_mode(AccountsService.UserPasswordMode.REGULAR)
+        else:
+            user.set_password_mode(AccountsService.UserPasswordMode.NONE)
+        self.on_password_set(record)
+
+    @xt.run_idle
+    def on_password_set(self, record):
+        self.running -= 1
+        record.set_status(UserRecord.STATUS_CREATED)
+        self.emit("record-changed", record)
+        self.fill()
+
+    def apply_groups(self):
+        additions = {} # group -> usernames
+        for record in self.records:
+            if record.status == UserRecord.STATUS_CREATED:
+                for group in record.get_groups():
+                    additions.setdefault(group, []).append(record.username)
+        self.apply_groups_thread(additions)
+
+    @xt.run_async
+    def apply_groups_thread(self, additions):
+        failures = {} # username -> groups which couldn't be updated
+        for group, user_names in additions.items():
+            # Read the members right before replacing them, so changes made
+            # meanwhile (e.g. by another tool) are kept
+            try:
+                members = read_local_groups().get(group)
+                error = _("Not a local group") if members is None else None
+            except OSError as e:
+                members = None
+                error = str(e)
+            if members is not None:
+                members = members + [user_name for user_name in user_names if user_name not in members]
+                try:
+                    result = subprocess.run(["gpasswd", "-M", ",".join(members), group], capture_output=True, text=True)
+                    error = result.stderr.strip() if result.returncode != 0 else None
+                except OSError as e:
+                    error = str(e)
+            if error is not None:
+                print(f"Unable to add users to group '{group}': {error}")
+                for user_name in user_names:
+                    failures.setdefault(user_name, []).append(group)
+        self.finish(failures)
+
+    @xt.run_idle
+    def finish(self, failures):
+        for record in self.records:
+            if record.status == UserRecord.STATUS_CREATED:
+                if record.username in failures:
+                    record.set_status(UserRecord.STATUS_FAILED, _("Created, but not added to: %s") % ", ".join(failures[record.username]))
+                else:
+                    record.set_status(UserRecord.STATUS_DONE)
+                self.emit("record-changed", record)
+        self.emit("finished")
+
+    def get_counts(self):
+        counts = collections.Counter(record.status for record in self.records)
+        return counts[UserRecord.STATUS_DONE], counts[UserRecord.STATUS_FAILED], len(self.records)
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+import ctypes
+import os
+import re
+import shutil
+import stat
+import subprocess
+
+SHADOW_PATH = "/etc/shadow"
+
+# Set the passwords of many users with a single chpasswd call, which hashes
+# them with the method configured in /etc/login.defs (blocking).
+# passwords is a list of (username, password), return a dict of the
+# usernames whose password couldn't be set, with the error.
+def set_passwords(passwords):
+    # The passwords go through stdin, not the command line
+    lines = "".join(f"{user_name}:{password}\n" for user_name, password in passwords)
+    try:
+        result = subprocess.run(["chpasswd"], input=lines, capture_output=True, text=True)
+    except OSError as e:
+        return {user_name: str(e) for user_name, password in passwords}
+    if result.returncode == 0:
+        return {}
+    # Errors mention the line number, or the user when PAM is used
+    user_names = [user_name for user_name, password in passwords]
+    failures = {}
+    for error in result.stderr.splitlines():
+        match = re.search(r"line (\d+)", error)
+        if match is not None and 0 < int(match.group(1)) <= len(user_names):
+            failures[user_names[int(match.group(1)) - 1]] = error
+            continue
+        match = re.search(r"\(user ([^)]+)\)", error)
+        if match is not None and match.group(1) in user_names:
+            failures[match.group(1)] = error
+    if len(failures) == 0:
+        error = result.stderr.strip() or f"chpasswd exited with status {result.returncode}"
+        failures = {user_name: error for user_name in user_names}
+    return failures
+
+# Require users to change their password at their next login, like 'chage -d 0'
+# but for any number of users with a single rewrite of the shadow file (blocking).
+# Like the shadow tools, the system file is only changed under their lock,
+# its previous content is kept in /etc/shadow-, and the nscd and sssd caches
+# are flushed afterwards. Return the usernames which weren't found, raise
+# OSError if the file couldn't be updated.
+def expire_passwords(user_names, path=SHADOW_PATH):
+    system_file = path == SHADOW_PATH
+    if system_file:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.lckpwdf() != 0:
+            raise OSError(ctypes.get_errno(), "Unable to lock the password files")
+    try:
+        missing = set(user_names)
+        lines = []
+        with open(path, "r") as shadow_file:
+            content = shadow_file.read()
+        for line in content.splitlines(keepends=True):
+            fields = line.rstrip("\n").split(":")
+            if len(fields) >= 3 and fields[0] in missing:
+                missing.discard(fields[0])
+                fields[2] = "0" # Date of the last password change
+                line = ":".join(fields) + "\n"
+            lines.append(line)
+        if len(missing) == len(set(user_names)):
+            return missing
+        stat_info = os.stat(path)
+        replace_file(path + "-", content, stat_info)
+        replace_file(path, "".join(lines), stat_info)
+    finally:
+        if system_file:
+            libc.ulckpwdf()
+    if system_file:
+        flush_caches()
+    return missing
+
+# Write a file through a temporary one, with the owner and mode of stat_info
+def replace_file(path, content, stat_info):
+    temp_path = path + "+"
+    try:
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600), "w") as temp_file:
+            os.fchown(temp_file.fileno(), stat_info.st_uid, stat_info.st_gid)
+            os.fchmod(temp_file.fileno(), stat.S_IMODE(stat_info.st_mode))
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+# The name service caches keep password entries, flush them like the shadow tools do
+def flush_caches():
+    for command in (["nscd", "-i", "shadow"], ["sss_cache", "-U"]):
+        if shutil.which(command[0]) is None:
+            continue
+        try:
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"Unable to run {command[0]}: {e}")
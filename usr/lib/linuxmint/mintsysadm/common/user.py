@@ -1,20 +1,294 @@
 #!/usr/bin/python3
 import cairo
+import configparser
 import gi
 import glob
-import math
+import hashlib
+import json
+import mmap
+import numpy
 import os
-import random
+import secrets
+import sys
 import tempfile
+import threading
+import xapp.threading as xt
 import xapp.util
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk, GdkPixbuf
-from PIL import Image, ImageOps
+from common.imaging import reduce_image
+from gi.repository import Gtk, GdkPixbuf, GLib
+from PIL import features, Image, ImageOps
 
 _ = xapp.util.l10n("mintsysadm")
 
 ICON_SIZE_DIALOG_PREVIEW = 128
 
+AVATAR_IMPORT_MAX_PIXELS = 80 * 1000 * 1000
+AVATAR_ENCODING_CONFIG = "/etc/mintsysadm/avatars.conf"
+
+# How avatars are written before being handed to AccountsService.
+# The defaults can be changed in the [encoding] section of AVATAR_ENCODING_CONFIG, e.g.
+#   size=256
+#   format=webp (png, jpeg or webp)
+#   quality=90 (jpeg and webp)
+#   optimize=true (png and jpeg)
+class AvatarEncoding():
+
+    FORMATS = {"png": ("PNG", ".png"), "jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+
+    def __init__(self, size=512, file_format="png", quality=90, optimize=False):
+        self.size = size
+        self.requested_format = file_format
+        # Unsupported formats fall back to PNG, see is_fallback()
+        self.file_format = file_format if self.is_supported(file_format) else "png"
+        self.quality = quality
+        self.optimize = optimize
+
+    @classmethod
+    def from_config(cls, path=AVATAR_ENCODING_CONFIG):
+        config = configparser.ConfigParser()
+        try:
+            config.read(path)
+            section = config["encoding"] if config.has_section("encoding") else {}
+            return cls(size=max(64, min(1024, int(section.get("size", 512)))),
+                       file_format=section.get("format", "png").lower(),
+                       quality=max(1, min(100, int(section.get("quality", 90)))),
+                       optimize=section.get("optimize", "false").lower() in ("true", "yes", "1"))
+        except (configparser.Error, ValueError) as e:
+            print(f"Invalid avatar encoding configuration: {e}")
+            return cls()
+
+    # Avatars are written with Pillow, but read with GdkPixbuf (here, in the
+    # greeters and in other tools), both need to support the format
+    @classmethod
+    def is_supported(cls, file_format):
+        if file_format not in cls.FORMATS:
+            return False
+        if file_format == "webp" and not features.check("webp"):
+            return False
+        return file_format in [pixbuf_format.get_name() for pixbuf_format in GdkPixbuf.Pixbuf.get_formats()]
+
+    # True if the requested format isn't supported and PNG is used instead
+    def is_fallback(self):
+        return self.file_format != self.requested_format
+
+    def get_suffix(self):
+        return self.FORMATS[self.file_format][1]
+
+    def __str__(self):
+        description = f"{self.requested_format} {self.size}px"
+        if self.requested_format in ("jpeg", "webp"):
+            description += f" q{self.quality}"
+        if self.optimize and self.requested_format in ("png", "jpeg"):
+            description += " optimized"
+        if self.is_fallback():
+            description += f" (unsupported, {self.file_format} used)"
+        return description
+
+    def save(self, pil_image, file):
+        pil_format = self.FORMATS[self.file_format][0]
+        if pil_image.size != (self.size, self.size):
+            pil_image = pil_image.resize((self.size, self.size), Image.LANCZOS)
+        if self.file_format == "png":
+            pil_image.save(file, pil_format, optimize=self.optimize)
+        elif self.file_format == "jpeg":
+            if pil_image.mode != "RGB":
+                # JPEG has no alpha channel, flatten on white
+                background = Image.new("RGB", pil_image.size, (255, 255, 255))
+                background.paste(pil_image, mask=pil_image.getchannel("A") if "A" in pil_image.getbands() else None)
+                pil_image = background
+            pil_image.save(file, pil_format, quality=self.quality, optimize=self.optimize)
+        else:
+            pil_image.save(file, pil_format, quality=self.quality, method=4)
+
+    # Save to a temporary file and return its path, the caller has to remove it
+    def save_to_temp_file(self, pil_image):
+        with tempfile.NamedTemporaryFile(mode='wb', suffix=self.get_suffix(), delete=False) as temp_file:
+            temp_path = temp_file.name
+            try:
+                self.save(pil_image, temp_file)
+            except Exception:
+                os.remove(temp_path)
+                raise
+        return temp_path
+
+avatar_encoding = AvatarEncoding.from_config()
+if avatar_encoding.is_fallback():
+    print(f"Avatar format '{avatar_encoding.requested_format}' is not supported, using png")
+
+AVATAR_CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), "mintsysadm", "avatars")
+AVATAR_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# An on-disk cache of rendered circular avatars.
+# Entries are PNG files named after a hash of the source path, its mtime and
+# size, and the logical size and scale factor they were rendered for.
+# The mtime of each entry is bumped on every hit and used for LRU eviction.
+class AvatarCache():
+
+    def __init__(self, directory=AVATAR_CACHE_DIR, max_bytes=AVATAR_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None # Computed on the first store
+        self.lock = threading.Lock()
+
+    def get_key(self, path, size, scale):
+        stat_info = os.stat(path)
+        key = f"{os.path.realpath(path)}:{stat_info.st_mtime_ns}:{stat_info.st_size}:{size}:{scale}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def lookup(self, key, scale):
+        entry = self.get_entry_path(key)
+        try:
+            surface = cairo.ImageSurface.create_from_png(entry)
+        except (cairo.Error, OSError):
+            return None
+        surface.set_device_scale(scale, scale)
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return surface
+
+    def store(self, key, surface):
+        entry = self.get_entry_path(key)
+        temp_path = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            surface.write_to_png(temp_path)
+            os.replace(temp_path, entry)
+            entry_size = os.path.getsize(entry)
+        except (cairo.Error, OSError) as e:
+            print(f"Unable to cache avatar: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self.get_disk_usage()
+            else:
+                self.total_bytes += entry_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def get_disk_usage(self):
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".png"):
+                        total += entry.stat().st_size
+        except OSError:
+            pass
+        return total
+
+    def evict(self):
+        # Drop the least recently used entries until we're back under 3/4 of the limit,
+        # so that we don't have to scan the directory again on the next store.
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".png"):
+                        stat_info = entry.stat()
+                        entries.append((stat_info.st_mtime, stat_info.st_size, entry.path))
+        except OSError:
+            return
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        target = self.max_bytes * 3 // 4
+        for mtime, entry_size, entry_path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(entry_path)
+                total -= entry_size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+avatar_cache = AvatarCache()
+
+STOCK_FACES_DIR = "/usr/share/pixmaps/faces/linuxmint"
+FACE_ATLAS_DIR = "/usr/share/mintsysadm/faces"
+FACE_ATLAS_INDEX = "index.json"
+FACE_ATLAS_VERSION = 1
+
+def get_face_atlas_filename(size, scale):
+    return f"faces-{size}@{scale}.bin"
+
+# Pre-rendered stock faces, generated at build time by generate_face_atlas.
+# Each atlas holds all the faces for one size and scale, stacked vertically as
+# raw cairo ARGB32 pixels, so a face is a contiguous slice of the mapped file.
+class FaceAtlas():
+
+    def __init__(self, directory=FACE_ATLAS_DIR, faces_dir=STOCK_FACES_DIR):
+        self.directory = directory
+        self.faces_dir = faces_dir
+        self.index = None
+        self.atlases = {} # (size, scale) -> mmap, or None if unavailable
+        self.lock = threading.Lock()
+
+    def load_index(self):
+        if self.index is not None:
+            return self.index
+        self.index = {}
+        try:
+            with open(os.path.join(self.directory, FACE_ATLAS_INDEX), "r") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return self.index
+        if index.get("version") != FACE_ATLAS_VERSION or index.get("byteorder") != sys.byteorder:
+            print("Ignoring incompatible face atlas")
+            return self.index
+        self.index = index
+        return self.index
+
+    def get_atlas(self, size, scale):
+        key = (size, scale)
+        if key not in self.atlases:
+            self.atlases[key] = None
+            if key in [tuple(entry) for entry in self.index.get("atlases", [])]:
+                path = os.path.join(self.directory, get_face_atlas_filename(size, scale))
+                try:
+                    with open(path, "rb") as atlas_file:
+                        self.atlases[key] = mmap.mmap(atlas_file.fileno(), 0, access=mmap.ACCESS_COPY)
+                except (OSError, ValueError) as e:
+                    print(f"Unable to map face atlas '{path}': {e}")
+        return self.atlases[key]
+
+    # Return a surface for a stock face, or None if it's not in the atlas
+    def get_surface(self, path, size, scale):
+        if os.path.dirname(os.path.realpath(path)) != self.faces_dir:
+            return None
+        with self.lock:
+            index = self.load_index()
+            face = index.get("faces", {}).get(os.path.basename(path))
+            if face is None:
+                return None
+            # Mtimes aren't reliable here (they get clamped when the package is built),
+            # but a replaced face would almost certainly have a different size.
+            if face["size"] != os.path.getsize(path):
+                return None
+            atlas = self.get_atlas(size, scale)
+            if atlas is None:
+                return None
+        scaled_size = size * scale
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, scaled_size)
+        length = stride * scaled_size
+        offset = face["position"] * length
+        if offset + length > len(atlas):
+            return None
+        surface = cairo.ImageSurface.create_for_data(memoryview(atlas)[offset:offset + length], cairo.FORMAT_ARGB32, scaled_size, scaled_size, stride)
+        surface.set_device_scale(scale, scale)
+        return surface
+
+face_atlas = FaceAtlas()
+
 def browse_avatar_dialog():
     """Show a file chooser dialog for browsing avatar images.
     Returns the selected file path or None if cancelled."""
@@ -53,26 +327,214 @@ def browse_avatar_dialog():
     box.set_valign(Gtk.Align.CENTER)
     box.set_size_request(ICON_SIZE_DIALOG_PREVIEW, -1)
 
+    def on_preview_loaded(path, surface):
+        if surface is not None:
+            preview.set_from_surface(surface)
+        else:
+            preview.clear()
+
+    preview_loader = AvatarPreviewLoader(ICON_SIZE_DIALOG_PREVIEW, on_preview_loaded)
+
     def update_preview_cb(dialog, preview):
         # Different widths make the dialog look really crappy as it resizes -
         # constrain the width and adjust the height to keep perspective.
         filename = dialog.get_preview_filename()
-        if filename is not None:
-            if os.path.isfile(filename):
-                try:
-                    set_image_from_avatar(preview, filename, ICON_SIZE_DIALOG_PREVIEW)
-                    return
-                except:
-                    print(f"Unable to generate preview for file '{filename}'")
-        preview.clear()
+        if filename is not None and os.path.isfile(filename):
+            preview_loader.request(filename, preview.get_scale_factor())
+        else:
+            preview_loader.cancel()
+            preview.clear()
 
     dialog.connect("update-preview", update_preview_cb, preview)
 
     response = dialog.run()
     path = dialog.get_filename() if response == Gtk.ResponseType.OK else None
+    preview_loader.stop()
     dialog.destroy()
     return path
 
+THUMBNAIL_DIR = os.path.join(GLib.get_user_cache_dir(), "thumbnails")
+THUMBNAIL_FLAVORS = [("normal", 128), ("large", 256), ("x-large", 512), ("xx-large", 1024)]
+
+# Return the freedesktop thumbnail flavors to use for a size, best first
+def get_thumbnail_flavors(scaled_size):
+    # Thumbnails fit in a square, so aim for twice the size to still cover it after cropping
+    for index, (flavor, flavor_size) in enumerate(THUMBNAIL_FLAVORS):
+        if flavor_size >= scaled_size * 2:
+            return THUMBNAIL_FLAVORS[index:]
+    return THUMBNAIL_FLAVORS[-1:]
+
+def get_thumbnail_path(uri, flavor):
+    filename = hashlib.md5(uri.encode("utf-8")).hexdigest() + ".png"
+    return os.path.join(THUMBNAIL_DIR, flavor, filename)
+
+# Look up a valid thumbnail for the file in the freedesktop thumbnail cache
+def load_thumbnail(path, scaled_size):
+    uri = GLib.filename_to_uri(os.path.abspath(path), None)
+    mtime = str(int(os.path.getmtime(path)))
+    for flavor, flavor_size in get_thumbnail_flavors(scaled_size):
+        thumbnail_path = get_thumbnail_path(uri, flavor)
+        if not os.path.exists(thumbnail_path):
+            continue
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumbnail_path)
+        except GLib.Error:
+            continue
+        if pixbuf.get_option("tEXt::Thumb::URI") == uri and pixbuf.get_option("tEXt::Thumb::MTime") == mtime:
+            return pixbuf
+    return None
+
+# Generate a thumbnail and save it to the freedesktop thumbnail cache
+def create_thumbnail(path, scaled_size):
+    flavor, flavor_size = get_thumbnail_flavors(scaled_size)[0]
+    file_format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+    if file_format is None:
+        raise ValueError(f"Unrecognized image file '{path}'")
+    if width <= flavor_size and height <= flavor_size:
+        # Small enough already, don't bother caching it
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+        return pixbuf.apply_embedded_orientation()
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, flavor_size, flavor_size, True)
+    pixbuf = pixbuf.apply_embedded_orientation()
+
+    uri = GLib.filename_to_uri(os.path.abspath(path), None)
+    mtime = str(int(os.path.getmtime(path)))
+    thumbnail_path = get_thumbnail_path(uri, flavor)
+    temp_path = f"{thumbnail_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(thumbnail_path), mode=0o700, exist_ok=True)
+        pixbuf.savev(temp_path, "png", ["tEXt::Thumb::URI", "tEXt::Thumb::MTime"], [uri, mtime])
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, thumbnail_path)
+    except (GLib.Error, OSError) as e:
+        print(f"Unable to save thumbnail for '{path}': {e}")
+    return pixbuf
+
+# Render circular previews in a thread, from the thumbnail cache when possible.
+# Only the most recent request is kept: requests made while the thread is busy
+# replace each other, and results for outdated requests are dropped.
+class AvatarPreviewLoader():
+
+    def __init__(self, size, callback):
+        self.size = size
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.running = True
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def request(self, path, scale):
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, path, scale)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending = None
+            self.condition.notify()
+
+    def is_stale(self, generation):
+        return generation != self.generation or not self.running
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                generation, path, scale = self.pending
+                self.pending = None
+            try:
+                surface = self.load(generation, path, scale)
+            except Exception as e:
+                print(f"Unable to generate preview for file '{path}': {e}")
+                surface = None
+            if not self.is_stale(generation):
+                self.deliver(generation, path, surface)
+
+    def load(self, generation, path, scale):
+        scaled_size = self.size * scale
+        pixbuf = load_thumbnail(path, scaled_size)
+        if pixbuf is None:
+            if self.is_stale(generation):
+                return None
+            pixbuf = create_thumbnail(path, scaled_size)
+        if self.is_stale(generation):
+            return None
+        return make_circular_surface(pixbuf, self.size, scale)
+
+    @xt.run_idle
+    def deliver(self, generation, path, surface):
+        if not self.is_stale(generation):
+            self.callback(path, surface)
+
+# Render avatars into images in a thread, lowest priority value first.
+# Each image has at most one pending request: a new request for an image
+# (e.g. a recycled card showing another user) replaces the previous one,
+# and results for replaced or cancelled requests are dropped.
+class AvatarLoader():
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {} # image -> (priority, generation, path, size, scale, fallback_size)
+        self.latest = {} # image -> generation of the request it's waiting for
+        self.generation = 0
+        self.thread = None
+
+    def request(self, image, path, size, fallback_size=Gtk.IconSize.DIALOG, priority=0):
+        scale = image.get_scale_factor()
+        with self.condition:
+            self.generation += 1
+            self.pending[image] = (priority, self.generation, path, size, scale, fallback_size)
+            self.latest[image] = self.generation
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel(self, image):
+        with self.condition:
+            self.pending.pop(image, None)
+            self.latest.pop(image, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                image = min(self.pending, key=lambda image: self.pending[image][:2])
+                priority, generation, path, size, scale, fallback_size = self.pending.pop(image)
+            try:
+                surface = get_avatar_surface(path, size, scale)
+            except Exception as e:
+                print(f"Unable to load avatar '{path}': {e}")
+                surface = None
+            self.deliver(image, generation, surface, size, fallback_size)
+
+    @xt.run_idle
+    def deliver(self, image, generation, surface, size, fallback_size):
+        with self.condition:
+            if self.latest.get(image) != generation:
+                return
+            del self.latest[image]
+        if surface is not None:
+            image.set_from_surface(surface)
+        else:
+            image.set_from_icon_name("xsi-avatar-default-symbolic", fallback_size)
+            image.set_pixel_size(size)
+
+avatar_loader = AvatarLoader()
+
 # Make a circular pixbuf and set the image with it
 # use a a symbolic avatar icon and fallback size if it fails
 def set_image_from_avatar(image, path, size, fallback_size=Gtk.IconSize.DIALOG):
@@ -81,86 +543,362 @@ def set_image_from_avatar(image, path, size, fallback_size=Gtk.IconSize.DIALOG):
         image.set_pixel_size(size)
         return
     scale = image.get_scale_factor()
-    scaled_size = size * scale
     try:
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
-        pixbuf = pixbuf.apply_embedded_orientation()
-        original_width = pixbuf.get_width()
-        original_height = pixbuf.get_height()
-
-        # Scale without distortion: cover the square then center-crop.
-        if original_width != scaled_size or original_height != scaled_size:
-            scale_factor = scaled_size / min(original_width, original_height)
-            scaled_width = max(scaled_size, int(round(original_width * scale_factor)))
-            scaled_height = max(scaled_size, int(round(original_height * scale_factor)))
-            pixbuf = pixbuf.scale_simple(scaled_width, scaled_height, GdkPixbuf.InterpType.BILINEAR)
-
-        if pixbuf.get_width() != pixbuf.get_height():
-            offset_x = max(0, (pixbuf.get_width() - scaled_size) // 2)
-            offset_y = max(0, (pixbuf.get_height() - scaled_size) // 2)
-            pixbuf = pixbuf.new_subpixbuf(offset_x, offset_y, scaled_size, scaled_size)
-
-        if pixbuf.get_width() != scaled_size or pixbuf.get_height() != scaled_size:
-            pixbuf = pixbuf.scale_simple(scaled_size, scaled_size, GdkPixbuf.InterpType.BILINEAR)
-
-        # Create a surface at the scaled size (physical pixels)
-        width = pixbuf.get_width()
-        height = pixbuf.get_height()
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        # Set device scale so cairo works in logical coordinates
-        surface.set_device_scale(scale, scale)
-
-        ctx = cairo.Context(surface)
-        # Draw circular clipping path using logical coordinates (size, not scaled_size)
-        radius = size // 2
-        ctx.arc(radius, radius, radius, math.pi, 3 * math.pi / 2)
-        ctx.arc(size - radius, radius, radius, 3 * math.pi / 2, 0)
-        ctx.arc(size - radius, size - radius, radius, 0, math.pi / 2)
-        ctx.arc(radius, size - radius, radius, math.pi / 2, math.pi)
-        ctx.close_path()
-        ctx.clip()
-        # Scale down the pixbuf to logical size when drawing
-        ctx.scale(1.0 / scale, 1.0 / scale)
-        Gdk.cairo_set_source_pixbuf(ctx, pixbuf, 0, 0)
-        ctx.paint()
-
+        surface = get_avatar_surface(path, size, scale)
         image.set_from_surface(surface)
     except Exception as e:
         image.set_from_icon_name("xsi-avatar-default-symbolic", fallback_size)
         image.set_pixel_size(size)
 
+# Return a circular surface for the avatar, from the face atlas or the cache if possible
+def get_avatar_surface(path, size, scale):
+    try:
+        surface = face_atlas.get_surface(path, size, scale)
+        if surface is not None:
+            return surface
+    except (OSError, cairo.Error, KeyError) as e:
+        print(f"Unable to read '{path}' from the face atlas: {e}")
+    try:
+        key = avatar_cache.get_key(path, size, scale)
+    except OSError:
+        key = None
+    if key is not None:
+        surface = avatar_cache.lookup(key, scale)
+        if surface is not None:
+            return surface
+    surface = render_avatar_surface(path, size, scale)
+    if key is not None:
+        avatar_cache.store(key, surface)
+    return surface
+
+# Return a (height, width, channels) view of the pixels of a pixbuf
+def get_pixbuf_array(pixbuf):
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    n_channels = pixbuf.get_n_channels()
+    data = numpy.frombuffer(pixbuf.read_pixel_bytes().get_data(), dtype=numpy.uint8)
+    # Don't use reshape, the last row isn't necessarily padded to the rowstride
+    return numpy.lib.stride_tricks.as_strided(data, shape=(height, width, n_channels), strides=(pixbuf.get_rowstride(), n_channels, 1), writeable=False)
+
+# Anti-aliased circular alpha masks, computed once per diameter and applied
+# to RGB or RGBA pixel arrays, writing premultiplied pixels straight into a
+# cairo ARGB32 surface. This avoids rasterizing a clip path and converting
+# the pixbuf through Gdk.cairo_set_source_pixbuf for every image.
+class CircularMask():
+
+    # Byte offsets of R, G, B and A in a native-endian cairo ARGB32 pixel
+    if sys.byteorder == "little":
+        OFFSETS = (2, 1, 0, 3)
+    else:
+        OFFSETS = (1, 2, 3, 0)
+
+    def __init__(self):
+        self.masks = {}
+        self.lock = threading.Lock()
+
+    def get_mask(self, diameter):
+        with self.lock:
+            mask = self.masks.get(diameter)
+            if mask is None:
+                # Coverage of each pixel, from the distance between its center and the circle's
+                radius = diameter / 2
+                coords = numpy.arange(diameter, dtype=numpy.float32) + 0.5 - radius
+                distance = numpy.sqrt(coords[numpy.newaxis, :] ** 2 + coords[:, numpy.newaxis] ** 2)
+                coverage = numpy.clip(radius - distance + 0.5, 0.0, 1.0)
+                mask = numpy.rint(coverage * 255).astype(numpy.uint16)
+                self.masks[diameter] = mask
+            return mask
+
+    # Apply the mask to a square (diameter, diameter, channels) array.
+    # The surface is reused if it has the right size, otherwise a new one is created.
+    def apply(self, pixels, surface=None):
+        diameter = pixels.shape[0]
+        mask = self.get_mask(diameter)
+        if surface is None or surface.get_width() != diameter or surface.get_height() != diameter:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, diameter, diameter)
+        surface.flush()
+        target = numpy.ndarray(shape=(diameter, diameter, 4), dtype=numpy.uint8, buffer=surface.get_data(), strides=(surface.get_stride(), 4, 1))
+        if pixels.shape[2] == 4:
+            alpha = (mask * pixels[:, :, 3] + 127) // 255
+        else:
+            alpha = mask
+        red, green, blue, alpha_offset = self.OFFSETS
+        for channel, offset in ((0, red), (1, green), (2, blue)):
+            target[:, :, offset] = (pixels[:, :, channel] * alpha + 127) // 255
+        target[:, :, alpha_offset] = alpha
+        surface.mark_dirty()
+        return surface
+
+circular_mask = CircularMask()
+
+# Load an image so that it covers a square of the given size (in physical pixels).
+# Large images are downscaled by the loader while decoding (JPEG uses DCT scaling),
+# so memory and time depend on the output size rather than on the input size.
+def load_avatar_pixbuf(path, scaled_size):
+    file_format, original_width, original_height = GdkPixbuf.Pixbuf.get_file_info(path)
+    if file_format is None or original_width <= 0 or original_height <= 0:
+        raise ValueError(f"Unrecognized image file '{path}'")
+
+    # The shortest side doesn't depend on the EXIF orientation,
+    # so we can compute the cover size before the image is rotated.
+    scale_factor = scaled_size / min(original_width, original_height)
+    if scale_factor < 1.0:
+        scaled_width = max(scaled_size, int(round(original_width * scale_factor)))
+        scaled_height = max(scaled_size, int(round(original_height * scale_factor)))
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, scaled_width, scaled_height, False)
+        return pixbuf.apply_embedded_orientation()
+
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+    return pixbuf.apply_embedded_orientation()
+
+def render_avatar_surface(path, size, scale):
+    pixbuf = load_avatar_pixbuf(path, size * scale)
+    return make_circular_surface(pixbuf, size, scale)
+
+# Make a circular surface of the given logical size from any pixbuf
+def make_circular_surface(pixbuf, size, scale):
+    scaled_size = size * scale
+    original_width = pixbuf.get_width()
+    original_height = pixbuf.get_height()
+
+    # Scale without distortion: cover the square then center-crop.
+    if min(original_width, original_height) != scaled_size:
+        scale_factor = scaled_size / min(original_width, original_height)
+        scaled_width = max(scaled_size, int(round(original_width * scale_factor)))
+        scaled_height = max(scaled_size, int(round(original_height * scale_factor)))
+        pixbuf = pixbuf.scale_simple(scaled_width, scaled_height, GdkPixbuf.InterpType.BILINEAR)
+
+    if pixbuf.get_width() != pixbuf.get_height():
+        offset_x = max(0, (pixbuf.get_width() - scaled_size) // 2)
+        offset_y = max(0, (pixbuf.get_height() - scaled_size) // 2)
+        pixbuf = pixbuf.new_subpixbuf(offset_x, offset_y, scaled_size, scaled_size)
+
+    if pixbuf.get_width() != scaled_size or pixbuf.get_height() != scaled_size:
+        pixbuf = pixbuf.scale_simple(scaled_size, scaled_size, GdkPixbuf.InterpType.BILINEAR)
+
+    # Create a surface at the scaled size (physical pixels)
+    surface = circular_mask.apply(get_pixbuf_array(pixbuf))
+    # Set device scale so cairo works in logical coordinates
+    surface.set_device_scale(scale, scale)
+    return surface
+
 def set_avatar(user, path, image, size, fallback_size=Gtk.IconSize.DIALOG):
     print(f"Setting avatar '{path}' for user '{user.get_user_name()}'")
     user.set_icon_file(path)
-    user.connect("changed", on_ac_user_changed, image, size, fallback_size)
-
-def set_avatar_from_browsed_path(user, path, image, size, fallback_size=Gtk.IconSize.DIALOG):
-    pil_image = Image.open(path)
-    pil_image = ImageOps.exif_transpose(pil_image)
-    # Preserve transparency when possible
-    if pil_image.mode not in ("RGB", "RGBA"):
-        print(f"Converting image from mode {pil_image.mode} to RGB")
-        pil_image = pil_image.convert("RGBA" if "A" in pil_image.getbands() else "RGB")
-    print(f"Selected image size: {pil_image.size}, mode: {pil_image.mode}")
-    pil_image = ImageOps.fit(pil_image, (512, 512), method=Image.LANCZOS, centering=(0.5, 0.5))
-    print(f"Resized image size: {pil_image.size}, mode: {pil_image.mode}")
-    with tempfile.NamedTemporaryFile(mode='wb', suffix='.png', delete=True) as temp_file:
-        temp_path = temp_file.name
-        pil_image.save(temp_path, "png")
-        set_avatar(user, temp_path, image, size, fallback_size=fallback_size)
-
-def on_ac_user_changed(user, image, size, fallback_size):
-    path = user.get_icon_file()
-    print(f"  --> New avatar path: '{path}'")
-    set_image_from_avatar(image, path, size, fallback_size)
+    avatar_bindings.bind(user, image, size, fallback_size, render=False)
+
+def set_avatar_from_browsed_path(user, path, image, size, fallback_size=Gtk.IconSize.DIALOG, parent=None):
+    def on_imported(importer, temp_path):
+        dialog.destroy()
+        if temp_path is not None:
+            set_avatar(user, temp_path, image, size, fallback_size=fallback_size)
+            os.remove(temp_path)
+        elif importer.error is not None:
+            error_dialog = Gtk.MessageDialog(transient_for=parent, modal=True, message_type=Gtk.MessageType.ERROR, buttons=Gtk.ButtonsType.CLOSE, text=importer.error)
+            error_dialog.run()
+            error_dialog.destroy()
+
+    importer = AvatarImporter(path, on_imported)
+    dialog = AvatarImportDialog(importer, parent)
+    importer.start()
+
+class AvatarImportCancelled(Exception):
+    pass
+
+# Convert a browsed picture into a square avatar file in a thread.
+# JPEG files are downscaled by the decoder, other formats are only decoded
+# if they're within AVATAR_IMPORT_MAX_PIXELS, and are reduced before being
+# transposed so that we never hold several full-size copies (see reduce_image()).
+class AvatarImporter():
+
+    def __init__(self, path, callback, progress_callback=None):
+        self.path = path
+        self.callback = callback
+        self.progress_callback = progress_callback
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def start(self):
+        self.run()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise AvatarImportCancelled()
+
+    @xt.run_async
+    def run(self):
+        temp_path = None
+        try:
+            temp_path = self.import_image()
+        except AvatarImportCancelled:
+            print(f"Import of '{self.path}' cancelled")
+        except Exception as e:
+            print(f"Unable to import '{self.path}': {e}")
+            self.error = _("The picture couldn't be loaded.")
+        self.finish(temp_path)
+
+    def import_image(self):
+        self.report_progress(0.0)
+        pil_image = Image.open(self.path)
+        # Let the decoder downscale (only supported by JPEG, a no-op otherwise)
+        size = avatar_encoding.size
+        pil_image.draft(None, (size, size))
+        width, height = pil_image.size
+        print(f"Selected image size: {pil_image.size}, mode: {pil_image.mode}")
+        if width * height > AVATAR_IMPORT_MAX_PIXELS:
+            raise ValueError(f"{width}x{height} exceeds the maximum of {AVATAR_IMPORT_MAX_PIXELS} pixels")
+        self.check_cancelled()
+
+        pil_image.load()
+        self.report_progress(0.4)
+        self.check_cancelled()
+
+        pil_image = reduce_image(pil_image, size)
+        self.report_progress(0.6)
+        self.check_cancelled()
+
+        pil_image = ImageOps.fit(pil_image, (size, size), method=Image.LANCZOS, centering=(0.5, 0.5))
+        print(f"Resized image size: {pil_image.size}, mode: {pil_image.mode}")
+        self.report_progress(0.8)
+        self.check_cancelled()
+
+        temp_path = avatar_encoding.save_to_temp_file(pil_image)
+        self.report_progress(1.0)
+        return temp_path
+
+    @xt.run_idle
+    def report_progress(self, fraction):
+        if self.progress_callback is not None:
+            self.progress_callback(self, fraction)
+
+    @xt.run_idle
+    def finish(self, temp_path):
+        if self.cancelled.is_set() and temp_path is not None:
+            os.remove(temp_path)
+            temp_path = None
+        self.callback(self, temp_path)
+
+# A progress dialog for an AvatarImporter, only shown if the import takes a while
+class AvatarImportDialog(Gtk.Dialog):
+
+    SHOW_DELAY = 300 # ms
+
+    def __init__(self, importer, parent=None):
+        super(AvatarImportDialog, self).__init__(title=_("Loading picture..."), transient_for=parent, modal=True)
+        self.importer = importer
+        self.importer.progress_callback = self.on_progress
+        self.set_skip_taskbar_hint(True)
+        self.set_skip_pager_hint(True)
+        self.set_border_width(6)
+        self.set_default_size(300, -1)
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_margin_top(12)
+        self.progress_bar.set_margin_bottom(12)
+        self.get_content_area().add(self.progress_bar)
+        self.add_button(_("Cancel"), Gtk.ResponseType.CANCEL)
+        self.connect("response", self.on_response)
+        self.show_timer = GLib.timeout_add(self.SHOW_DELAY, self.on_show_timeout)
+
+    def on_show_timeout(self):
+        self.show_timer = 0
+        self.show_all()
+        return False
+
+    def on_progress(self, importer, fraction):
+        self.progress_bar.set_fraction(fraction)
+
+    def on_response(self, dialog, response_id):
+        self.importer.cancel()
+        self.hide()
+
+    def destroy(self):
+        if self.show_timer > 0:
+            GLib.source_remove(self.show_timer)
+            self.show_timer = 0
+        super().destroy()
+
+# Return something that changes whenever the avatar file is replaced or modified
+def get_avatar_signature(path):
+    try:
+        stat_info = os.stat(path)
+    except (OSError, TypeError):
+        return (path, None, None)
+    return (path, stat_info.st_mtime_ns, stat_info.st_size)
+
+class AvatarBinding():
+
+    def __init__(self, user, size, fallback_size):
+        self.user = user
+        self.size = size
+        self.fallback_size = fallback_size
+        self.signature = None
+        self.changed_id = 0
+        self.destroy_id = 0
+        self.priority = None # Loaded in the background with this priority if not None
+
+# Keeps images showing the avatar of a user up to date.
+# There's at most one "changed" handler per image, the image is only
+# redrawn when the icon file actually changed, and the binding goes away
+# with the image. Bindings made with a priority show a placeholder and
+# get their avatar from the avatar loader.
+class AvatarBindings():
+
+    def __init__(self):
+        self.bindings = {} # image -> AvatarBinding
+
+    def bind(self, user, image, size, fallback_size=Gtk.IconSize.DIALOG, render=True, priority=None):
+        binding = self.bindings.get(image)
+        if binding is not None and binding.user is not user:
+            self.unbind(image)
+            binding = None
+        if binding is None:
+            binding = AvatarBinding(user, size, fallback_size)
+            binding.changed_id = user.connect("changed", self.on_user_changed, image)
+            binding.destroy_id = image.connect("destroy", self.unbind)
+            self.bindings[image] = binding
+        elif binding.size != size or binding.fallback_size != fallback_size:
+            binding.size = size
+            binding.fallback_size = fallback_size
+            binding.signature = None
+        binding.priority = priority
+        if render:
+            self.update(image, binding)
+
+    def unbind(self, image):
+        binding = self.bindings.pop(image, None)
+        if binding is not None:
+            binding.user.disconnect(binding.changed_id)
+            image.disconnect(binding.destroy_id)
+            if binding.priority is not None:
+                avatar_loader.cancel(image)
+
+    def on_user_changed(self, user, image):
+        binding = self.bindings.get(image)
+        if binding is not None:
+            self.update(image, binding)
+
+    def update(self, image, binding):
+        path = binding.user.get_icon_file()
+        signature = get_avatar_signature(path)
+        if signature != binding.signature:
+            binding.signature = signature
+            if binding.priority is None or signature[1] is None:
+                avatar_loader.cancel(image)
+                set_image_from_avatar(image, path, binding.size, binding.fallback_size)
+            else:
+                image.set_from_icon_name("xsi-avatar-default-symbolic", binding.fallback_size)
+                image.set_pixel_size(binding.size)
+                avatar_loader.request(image, path, binding.size, binding.fallback_size, binding.priority)
+
+avatar_bindings = AvatarBindings()
 
+# Generated passwords are handed out to users, use a cryptographically secure source
 def generate_password():
     characters = "!@#$%^&*()_-+{}|:<>?=0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    newpass = ""
-    for i in range(14):
-        index = random.randint(0, len(characters) - 1)
-        newpass = newpass + characters[index]
-    return newpass
+    return "".join(secrets.choice(characters) for i in range(14))
 
 # Based on setPasswordStrength() in Mozilla Seamonkey, which is tri-licensed under MPL 1.1, GPL 2.0, and LGPL 2.1.
 # Forked from Ubiquity validation.py
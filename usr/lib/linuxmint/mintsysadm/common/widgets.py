@@ -1,9 +1,13 @@
 #!/usr/bin/python3
+import bisect
 import gi
+import xapp.threading as xt
 import xapp.util
 
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GObject
+from common.faces import get_face_label, get_face_library
+from common.user import get_avatar_surface
+from gi.repository import Gtk, Gdk, GLib, GObject
 
 _ = xapp.util.l10n("mintsysadm")
 
@@ -98,3 +102,424 @@ class DimmedTable (Gtk.Table):
             self.attach(control, 1, 2, row, row+1)
             row = row + 1
 
+# A popover to pick a face from the face library, followed by action buttons.
+# The faces are searchable and paginated, only the faces of the current page
+# are rendered (in a thread, streamed into placeholder images), and they're
+# released when the picker isn't used for a while.
+class FacePicker(Gtk.Popover):
+    __gsignals__ = {
+        'face-selected': (GObject.SignalFlags.RUN_FIRST, None, (str,))
+    }
+
+    RELEASE_TIMEOUT = 60 # seconds
+
+    def __init__(self, relative_to, icon_size, num_cols=6, num_rows=4):
+        super(FacePicker, self).__init__(relative_to=relative_to)
+        self.set_position(Gtk.PositionType.BOTTOM)
+        self.icon_size = icon_size
+        self.faces_per_page = num_cols * num_rows
+        self.library = None # Loaded on first popup
+        self.paths = [] # Faces matching the search
+        self.page = 0
+        self.face_images = [] # (path, image) pairs on the current page
+        self.loaded_scale = None # Scale factor of the faces currently shown, None if released
+        self.generation = 0 # Bumped to discard results from outdated threads
+        self.release_timer = 0
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.set_border_width(6)
+
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text(_("Search pictures"))
+        self.search_entry.connect("search-changed", self._on_search_changed)
+        box.pack_start(self.search_entry, False, False, 0)
+
+        self.flowbox = Gtk.FlowBox()
+        self.flowbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.flowbox.set_homogeneous(True)
+        self.flowbox.set_min_children_per_line(num_cols)
+        self.flowbox.set_max_children_per_line(num_cols)
+        box.pack_start(self.flowbox, True, True, 0)
+
+        pager = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.previous_button = Gtk.Button.new_from_icon_name("xsi-go-previous-symbolic", Gtk.IconSize.BUTTON)
+        self.previous_button.set_relief(Gtk.ReliefStyle.NONE)
+        self.previous_button.connect("clicked", self._on_page_clicked, -1)
+        self.next_button = Gtk.Button.new_from_icon_name("xsi-go-next-symbolic", Gtk.IconSize.BUTTON)
+        self.next_button.set_relief(Gtk.ReliefStyle.NONE)
+        self.next_button.connect("clicked", self._on_page_clicked, 1)
+        self.page_label = Gtk.Label()
+        self.page_label.get_style_context().add_class("dim-label")
+        pager.pack_start(self.previous_button, False, False, 0)
+        pager.set_center_widget(self.page_label)
+        pager.pack_end(self.next_button, False, False, 0)
+        box.pack_start(pager, False, False, 0)
+
+        box.pack_start(Gtk.Separator(), False, False, 0)
+        self.actions_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.pack_start(self.actions_box, False, False, 0)
+
+        box.show_all()
+        self.add(box)
+
+        self.connect("show", self._on_show)
+        self.connect("closed", self._on_closed)
+
+    # Add a button below the faces
+    def add_action(self, label, callback):
+        button = Gtk.ModelButton(text=label)
+        button.connect("clicked", self._on_action_clicked, callback)
+        button.show()
+        self.actions_box.pack_start(button, False, False, 0)
+
+    def popup_for_button(self):
+        if self.library is None:
+            self.library = get_face_library()
+            self.library.connect("changed", self._on_library_changed)
+            self.paths = self.library.search(self.search_entry.get_text())
+        if self.loaded_scale != self.get_relative_to().get_scale_factor():
+            self.show_page()
+        self.popup()
+
+    def get_num_pages(self):
+        return max(1, (len(self.paths) + self.faces_per_page - 1) // self.faces_per_page)
+
+    def show_page(self):
+        self.generation += 1
+        self.page = max(0, min(self.page, self.get_num_pages() - 1))
+        for child in self.flowbox.get_children():
+            child.destroy()
+        self.face_images = []
+
+        start = self.page * self.faces_per_page
+        paths = self.paths[start:start + self.faces_per_page]
+        for path in paths:
+            image = Gtk.Image()
+            self.set_placeholder(image)
+            button = Gtk.Button()
+            button.set_relief(Gtk.ReliefStyle.NONE)
+            button.set_tooltip_text(get_face_label(path))
+            button.add(image)
+            button.connect("clicked", self._on_face_clicked, path)
+            self.flowbox.add(button)
+            self.face_images.append((path, image))
+        self.flowbox.show_all()
+
+        if len(self.paths) == 0:
+            self.page_label.set_text(_("No pictures found"))
+        else:
+            self.page_label.set_text("%d / %d" % (self.page + 1, self.get_num_pages()))
+        self.previous_button.set_sensitive(self.page > 0)
+        self.next_button.set_sensitive(self.page < self.get_num_pages() - 1)
+
+        self.loaded_scale = self.get_relative_to().get_scale_factor()
+        self.load_faces_thread(self.generation, paths, self.loaded_scale)
+
+    def set_placeholder(self, image):
+        image.set_from_icon_name("xsi-avatar-default-symbolic", Gtk.IconSize.DIALOG)
+        image.set_pixel_size(self.icon_size)
+
+    @xt.run_async
+    def load_faces_thread(self, generation, paths, scale):
+        for index, path in enumerate(paths):
+            if generation != self.generation:
+                return
+            try:
+                surface = get_avatar_surface(path, self.icon_size, scale)
+            except Exception as e:
+                print(f"Unable to load face '{path}': {e}")
+                continue
+            self.set_face_surface(generation, index, surface)
+
+    @xt.run_idle
+    def set_face_surface(self, generation, index, surface):
+        if generation == self.generation:
+            path, image = self.face_images[index]
+            image.set_from_surface(surface)
+
+    def release_faces(self):
+        self.release_timer = 0
+        self.generation += 1
+        self.loaded_scale = None
+        for child in self.flowbox.get_children():
+            child.destroy()
+        self.face_images = []
+        return False
+
+    def _on_search_changed(self, entry):
+        if self.library is not None:
+            self.paths = self.library.search(entry.get_text())
+            self.page = 0
+            self.show_page()
+
+    def _on_page_clicked(self, button, offset):
+        self.page += offset
+        self.show_page()
+
+    def _on_library_changed(self, library):
+        self.paths = library.search(self.search_entry.get_text())
+        if self.get_visible():
+            self.show_page()
+        else:
+            if self.release_timer > 0:
+                GLib.source_remove(self.release_timer)
+            self.release_faces()
+
+    def _on_face_clicked(self, button, path):
+        self.popdown()
+        self.emit("face-selected", path)
+
+    def _on_action_clicked(self, button, callback):
+        self.popdown()
+        callback(button)
+
+    def _on_show(self, popover):
+        if self.release_timer > 0:
+            GLib.source_remove(self.release_timer)
+            self.release_timer = 0
+
+    def _on_closed(self, popover):
+        if self.release_timer == 0:
+            self.release_timer = GLib.timeout_add_seconds(self.RELEASE_TIMEOUT, self.release_faces)
+
+# A scrollable grid of fixed-size cards showing a list of items.
+# Only the cards of the visible rows exist: they're recycled while scrolling
+# and bound to the item they show with bind_func(card, item, priority), the
+# priority being the position of the item in the grid (lower is nearer the top).
+# In selection mode, cards are selected instead of activated, selected cards
+# have the SELECTED state flag.
+class CardGrid(Gtk.Layout):
+    __gsignals__ = {
+        'item-activated': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
+        'selection-changed': (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self, create_func, bind_func, card_width, card_height, spacing=12, margin=24, max_columns=10):
+        super(CardGrid, self).__init__()
+        self.create_func = create_func
+        self.bind_func = bind_func
+        self.card_width = card_width
+        self.card_height = card_height
+        self.spacing = spacing
+        self.margin = margin
+        self.max_columns = max_columns
+        self.sort_key_func = None
+        self.filter_func = None
+        self.items = [] # All the items, sorted
+        self.shown_items = [] # The items passing the filter
+        self.cards = {} # item -> bound card
+        self.indexes = {} # item -> position, for the items with a card
+        self.card_items = {} # card -> item
+        self.positions = {} # card -> (x, y)
+        self.spare_cards = []
+        self.selection_mode = False
+        self.selected_items = set()
+        self.allocated_size = None
+        self.layout_id = 0
+        self.scroll_adjustment = None
+        self.value_changed_id = 0
+
+        self.set_can_focus(False)
+        self.connect("notify::vadjustment", self._on_vadjustment_changed)
+        self.connect("size-allocate", self._on_size_allocate)
+        self._on_vadjustment_changed(self, None)
+
+    def set_sort_key_func(self, func):
+        self.sort_key_func = func
+        self.sort()
+
+    def set_filter_func(self, func):
+        self.filter_func = func
+        self.refilter()
+
+    def set_items(self, items):
+        self.items = list(items)
+        self.sort()
+
+    # Insert an item at its sorted position, use set_items() to add many at once
+    def add_item(self, item):
+        shown = self.filter_func is None or self.filter_func(item)
+        if self.sort_key_func is None:
+            self.items.append(item)
+            if shown:
+                self.shown_items.append(item)
+        else:
+            bisect.insort(self.items, item, key=self.sort_key_func)
+            if shown:
+                bisect.insort(self.shown_items, item, key=self.sort_key_func)
+        self.queue_relayout()
+
+    def remove_item(self, item):
+        self.items.remove(item)
+        self.refilter()
+
+    def set_selection_mode(self, selection_mode):
+        self.selection_mode = selection_mode
+        if not selection_mode:
+            self.unselect_all()
+
+    # Return the selected items, in the order they're shown
+    def get_selected_items(self):
+        return [item for item in self.shown_items if item in self.selected_items]
+
+    def set_selected(self, item, selected):
+        if selected:
+            self.selected_items.add(item)
+        else:
+            self.selected_items.discard(item)
+        card = self.cards.get(item)
+        if card is not None:
+            self.update_card_state(card, item)
+        self.emit("selection-changed")
+
+    def select_all(self):
+        self.set_selection(set(self.shown_items))
+
+    def unselect_all(self):
+        self.set_selection(set())
+
+    def set_selection(self, items):
+        if items == self.selected_items:
+            return
+        self.selected_items = items
+        for item, card in self.cards.items():
+            self.update_card_state(card, item)
+        self.emit("selection-changed")
+
+    def update_card_state(self, card, item):
+        if item in self.selected_items:
+            card.set_state_flags(Gtk.StateFlags.SELECTED, False)
+        else:
+            card.unset_state_flags(Gtk.StateFlags.SELECTED)
+
+    # Refresh the card of an item, call sort() too if its sort key changed
+    def update_item(self, item):
+        card = self.cards.get(item)
+        if card is not None:
+            self.bind_func(card, item, self.indexes[item])
+
+    # Refresh all the cards
+    def update_items(self):
+        for item, card in self.cards.items():
+            self.bind_func(card, item, self.indexes[item])
+
+    def sort(self):
+        if self.sort_key_func is not None:
+            self.items.sort(key=self.sort_key_func)
+        self.refilter()
+
+    def refilter(self):
+        if self.filter_func is None:
+            self.shown_items = list(self.items)
+        else:
+            self.shown_items = [item for item in self.items if self.filter_func(item)]
+        # Hidden or removed items can't stay selected
+        if len(self.selected_items) > 0:
+            self.set_selection(self.selected_items.intersection(self.shown_items))
+        self.queue_relayout()
+
+    def get_item_count(self):
+        return len(self.shown_items)
+
+    # Return the items which currently have a card
+    def get_bound_items(self):
+        return list(self.cards.keys())
+
+    def queue_relayout(self):
+        # Run before the next redraw
+        if self.layout_id == 0:
+            self.layout_id = GLib.idle_add(self.relayout, priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def relayout(self):
+        if self.layout_id > 0:
+            GLib.source_remove(self.layout_id)
+            self.layout_id = 0
+
+        width = self.get_allocated_width()
+        cell_width = self.card_width + self.spacing
+        cell_height = self.card_height + self.spacing
+        columns = max(1, min(self.max_columns, (width - 2 * self.margin + self.spacing) // cell_width))
+        rows = (len(self.shown_items) + columns - 1) // columns
+        height = 2 * self.margin + max(0, rows * cell_height - self.spacing)
+        if self.get_size() != (width, height):
+            self.set_size(width, height)
+        x_start = max(self.margin, (width - columns * cell_width + self.spacing) // 2)
+
+        if self.scroll_adjustment is not None and self.scroll_adjustment.get_page_size() > 0:
+            top = self.scroll_adjustment.get_value()
+            bottom = top + self.scroll_adjustment.get_page_size()
+        else:
+            top = 0
+            bottom = self.get_allocated_height()
+        first_row = max(0, int(top - self.margin) // cell_height)
+        last_row = max(0, int(bottom - self.margin) // cell_height)
+        start = min(len(self.shown_items), first_row * columns)
+        end = min(len(self.shown_items), (last_row + 1) * columns)
+        visible_items = self.shown_items[start:end]
+
+        # Recycle the cards which scrolled out of view
+        visible_set = set(visible_items)
+        for item in [item for item in self.cards if item not in visible_set]:
+            card = self.cards.pop(item)
+            del self.card_items[card]
+            del self.indexes[item]
+            card.hide()
+            self.spare_cards.append(card)
+
+        for index, item in enumerate(visible_items, start):
+            card = self.cards.get(item)
+            if card is None:
+                card = self.spare_cards.pop() if len(self.spare_cards) > 0 else self.create_card()
+                self.cards[item] = card
+                self.card_items[card] = item
+                self.bind_func(card, item, index)
+                self.update_card_state(card, item)
+            self.indexes[item] = index
+            position = (x_start + (index % columns) * cell_width, self.margin + (index // columns) * cell_height)
+            if self.positions.get(card) != position:
+                self.positions[card] = position
+                self.move(card, *position)
+            card.show()
+        return False
+
+    def create_card(self):
+        card = self.create_func()
+        card.set_can_focus(True)
+        card.add_events(Gdk.EventMask.BUTTON_RELEASE_MASK | Gdk.EventMask.KEY_PRESS_MASK)
+        card.connect("button-release-event", self._on_card_button_released)
+        card.connect("key-press-event", self._on_card_key_pressed)
+        self.positions[card] = (0, 0)
+        self.put(card, 0, 0)
+        return card
+
+    def activate_card(self, card):
+        item = self.card_items[card]
+        if self.selection_mode:
+            self.set_selected(item, item not in self.selected_items)
+        else:
+            self.emit("item-activated", item)
+
+    def _on_card_button_released(self, card, event):
+        if event.button == 1 and card in self.card_items:
+            self.activate_card(card)
+        return False
+
+    def _on_card_key_pressed(self, card, event):
+        if event.keyval in (Gdk.KEY_Return, Gdk.KEY_KP_Enter, Gdk.KEY_space) and card in self.card_items:
+            self.activate_card(card)
+            return True
+        return False
+
+    def _on_vadjustment_changed(self, layout, param):
+        if self.scroll_adjustment is not None:
+            self.scroll_adjustment.disconnect(self.value_changed_id)
+        self.scroll_adjustment = self.get_vadjustment()
+        if self.scroll_adjustment is not None:
+            # Lay out right away, so no empty rows are drawn while scrolling
+            self.value_changed_id = self.scroll_adjustment.connect("value-changed", lambda adjustment: self.relayout())
+
+    def _on_size_allocate(self, layout, allocation):
+        size = (allocation.width, allocation.height)
+        if size != self.allocated_size:
+            self.allocated_size = size
+            self.queue_relayout()
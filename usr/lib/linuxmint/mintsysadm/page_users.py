@@ -1,18 +1,28 @@
 #!/usr/bin/python3
 import datetime
 import gi
+import locale
 import os
+import pwd
 import re
-import shutil
 import subprocess
 import xapp.SettingsWidgets as xs
 import xapp.threading as xt
 import xapp.util
 gi.require_version("AccountsService", "1.0")
 gi.require_version("Gtk", "3.0")
-from common.user import generate_password, get_password_strength, set_image_from_avatar, set_avatar, set_avatar_from_browsed_path, browse_avatar_dialog
-from common.widgets import DimmedTable, EditableEntry
-from gi.repository import Gtk, Gdk, AccountsService
+gi.require_version("Pango", "1.0")
+from common.accounts import SearchIndex, get_group_index, get_session_index, get_user_groups, get_user_index, read_local_groups, set_supplementary_groups
+from common.batch import UserBatch
+from common.deletion import get_deletion_jobs
+from common.diskusage import get_disk_usage_monitor
+from common.encryption import get_encryption_jobs
+from common.logins import btmp_log, wtmp_log
+from common.provisioning import UserProvisioner, UserRecord, read_user_file, validate_records, write_credential_sheet
+from common.shadow import expire_passwords, set_passwords
+from common.user import avatar_bindings, generate_password, get_password_strength, set_avatar, set_avatar_from_browsed_path, browse_avatar_dialog
+from common.widgets import CardGrid, DimmedTable, EditableEntry, FacePicker
+from gi.repository import Gtk, Gdk, GLib, Pango, AccountsService
 
 _ = xapp.util.l10n("mintsysadm")
 
@@ -20,12 +30,18 @@ ICON_SIZE_DIALOG_PREVIEW = 128
 ICON_SIZE_CHOOSE_BUTTON = 96
 ICON_SIZE_FLOWBOX = 96
 ICON_SIZE_CHOOSE_MENU = 48
+VALIDATION_DELAY = 150 # ms
+USER_CARD_WIDTH = 160
+USER_CARD_HEIGHT = 232
 
 class NewUserDialog(Gtk.Dialog):
 
     def __init__ (self, parent = None):
         super(NewUserDialog, self).__init__(None, parent)
 
+        self.validation_timer = 0
+        self.connect("destroy", self._on_destroy)
+
         try:
             self.set_modal(True)
             self.set_skip_taskbar_hint(True)
@@ -95,15 +111,22 @@ class NewUserDialog(Gtk.Dialog):
             print(detail)
 
     def user_exists(self, user_name):
-        users = AccountsService.UserManager.get_default().list_users()
+        return get_user_index().user_exists(user_name)
 
-        for user in users:
-            if user.get_user_name() == user_name:
-                return True
+    # Validate once typing pauses, the OK button stays insensitive meanwhile
+    def _on_info_changed(self, widget):
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        if self.validation_timer > 0:
+            GLib.source_remove(self.validation_timer)
+        self.validation_timer = GLib.timeout_add(VALIDATION_DELAY, self.validate)
 
-        return False
+    def _on_destroy(self, widget):
+        if self.validation_timer > 0:
+            GLib.source_remove(self.validation_timer)
+            self.validation_timer = 0
 
-    def _on_info_changed(self, widget):
+    def validate(self):
+        self.validation_timer = 0
         fullname = self.realname_entry.get_text()
         username = self.username_entry.get_text()
         valid = True
@@ -129,6 +152,7 @@ class NewUserDialog(Gtk.Dialog):
                 self.password_entry.set_icon_from_icon_name(Gtk.EntryIconPosition.SECONDARY, None)
 
         self.set_response_sensitive(Gtk.ResponseType.OK, valid)
+        return False
 
     def _on_encrypt_switch_changed(self, switch, state):
         if state:
@@ -143,6 +167,513 @@ class NewUserDialog(Gtk.Dialog):
         self._on_info_changed(None)
         return False
 
+# A dialog to create users in bulk from a CSV or JSON file.
+# The whole file is validated before anything is created.
+class ImportUsersDialog(Gtk.Dialog):
+
+    COLUMN_LINE, COLUMN_USERNAME, COLUMN_FULLNAME, COLUMN_ADMIN, COLUMN_GROUPS, COLUMN_STATUS = range(6)
+
+    def __init__ (self, parent = None):
+        super(ImportUsersDialog, self).__init__(None, parent)
+
+        self.records = []
+        self.iters = {} # record -> row
+        self.provisioner = None
+        self.closing = False
+        self.generation = 0 # Bumped to discard the results of outdated file reads
+
+        self.set_modal(True)
+        self.set_skip_taskbar_hint(True)
+        self.set_skip_pager_hint(True)
+        self.set_title(_("Import Users"))
+        self.set_default_size(700, 450)
+        self.set_border_width(6)
+
+        box = self.get_content_area()
+        box.set_spacing(6)
+
+        explanation = Gtk.Label()
+        explanation.set_markup("<small>%s</small>" % _("Choose a CSV file with a header line, or a JSON file with a list of objects. The columns are: username, fullname, administrator, password and groups."))
+        explanation.set_alignment(0.0, 0.5)
+        explanation.set_line_wrap(True)
+        explanation.get_style_context().add_class("dim-label")
+        box.pack_start(explanation, False, False, 0)
+
+        self.file_button = Gtk.FileChooserButton(title=_("Choose a file"), action=Gtk.FileChooserAction.OPEN)
+        file_filter = Gtk.FileFilter()
+        file_filter.set_name(_("CSV and JSON files"))
+        file_filter.add_pattern("*.csv")
+        file_filter.add_pattern("*.json")
+        file_filter.add_mime_type("text/csv")
+        file_filter.add_mime_type("application/json")
+        self.file_button.add_filter(file_filter)
+        self.file_button.connect("file-set", self._on_file_set)
+        box.pack_start(self.file_button, False, False, 0)
+
+        self.store = Gtk.ListStore(int, str, str, str, str, str)
+        treeview = Gtk.TreeView(model=self.store)
+        columns = [(_("Line"), self.COLUMN_LINE), (_("Username"), self.COLUMN_USERNAME), (_("Full Name"), self.COLUMN_FULLNAME),
+                   (_("Administrator"), self.COLUMN_ADMIN), (_("Groups"), self.COLUMN_GROUPS), (_("Status"), self.COLUMN_STATUS)]
+        for title, column_id in columns:
+            column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text=column_id)
+            column.set_resizable(True)
+            treeview.append_column(column)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled_window.add(treeview)
+        box.pack_start(scrolled_window, True, True, 0)
+
+        self.progress_bar = Gtk.ProgressBar()
+        box.pack_start(self.progress_bar, False, False, 0)
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_alignment(0.0, 0.5)
+        box.pack_start(self.summary_label, False, False, 0)
+
+        self.add_buttons(_("Close"), Gtk.ResponseType.CLOSE, _("Import"), Gtk.ResponseType.OK)
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.get_widget_for_response(Gtk.ResponseType.OK).get_style_context().add_class("suggested-action")
+        self.connect("response", self._on_response)
+        box.show_all()
+
+    def _on_file_set(self, button):
+        self.generation += 1
+        self.store.clear()
+        self.records = []
+        self.iters = {}
+        self.progress_bar.set_fraction(0.0)
+        self.summary_label.set_text(_("Reading the file..."))
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.read_file(self.generation, button.get_filename(), get_user_index().get_user_names())
+
+    @xt.run_async
+    def read_file(self, generation, path, known_names):
+        try:
+            records = read_user_file(path)
+            validate_records(records, known_names, read_local_groups())
+            error = None
+        except (OSError, ValueError) as e:
+            records = []
+            error = str(e)
+        self.show_records(generation, records, error)
+
+    @xt.run_idle
+    def show_records(self, generation, records, error):
+        if generation != self.generation:
+            return
+        self.records = records
+        for record in records:
+            self.iters[record] = self.store.append([record.line, record.username, record.fullname,
+                                                    _("Yes") if record.administrator else _("No"),
+                                                    ", ".join(record.groups), self.get_status_text(record)])
+        if error is not None:
+            self.summary_label.set_text(error)
+            return
+        num_valid = len([record for record in records if record.status == UserRecord.STATUS_WAITING])
+        num_invalid = len(records) - num_valid
+        self.summary_label.set_text(_("%(valid)d users ready to be imported, %(invalid)d with errors.") % {"valid": num_valid, "invalid": num_invalid})
+        self.set_response_sensitive(Gtk.ResponseType.OK, num_valid > 0)
+
+    def get_status_text(self, record):
+        if record.status == UserRecord.STATUS_INVALID:
+            return record.message
+        elif record.status == UserRecord.STATUS_WAITING:
+            return _("Waiting")
+        elif record.status == UserRecord.STATUS_CREATING:
+            return _("Creating...")
+        elif record.status == UserRecord.STATUS_CREATED:
+            return _("Adding to groups...")
+        elif record.status == UserRecord.STATUS_DONE:
+            return _("Done")
+        else:
+            return _("Failed: %s") % record.message
+
+    def _on_response(self, dialog, response_id):
+        if response_id == Gtk.ResponseType.OK:
+            self.start_import()
+        elif self.provisioner is not None:
+            # Let the users being created finish, then close
+            self.closing = True
+            self.summary_label.set_text(_("Stopping..."))
+            self.set_response_sensitive(Gtk.ResponseType.CLOSE, False)
+            self.provisioner.cancel()
+        else:
+            self.destroy()
+
+    def start_import(self):
+        self.file_button.set_sensitive(False)
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.provisioner = UserProvisioner(self.records)
+        self.provisioner.connect("record-changed", self._on_record_changed)
+        self.provisioner.connect("finished", self._on_import_finished)
+        self.provisioner.start()
+
+    def _on_record_changed(self, provisioner, record):
+        self.store.set_value(self.iters[record], self.COLUMN_STATUS, self.get_status_text(record))
+        num_done = len([record for record in provisioner.records if record.status in (UserRecord.STATUS_CREATED, UserRecord.STATUS_DONE, UserRecord.STATUS_FAILED)])
+        self.progress_bar.set_fraction(num_done / len(provisioner.records))
+
+    def _on_import_finished(self, provisioner):
+        num_done, num_failed, num_total = provisioner.get_counts()
+        self.provisioner = None
+        if self.closing:
+            self.destroy()
+            return
+        self.progress_bar.set_fraction(1.0)
+        self.summary_label.set_text(_("%(done)d of %(total)d users created, %(failed)d failed.") % {"done": num_done, "total": num_total, "failed": num_failed})
+
+# The logins (or failed login attempts) of a user, most recent first.
+# Pages of records are read in a thread when the list is scrolled to the bottom.
+class LoginHistoryView(Gtk.Box):
+
+    PAGE_SIZE = 50
+
+    def __init__(self, log, user_name):
+        super(LoginHistoryView, self).__init__(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.log = log
+        self.user_name = user_name
+        self.loaded = 0
+        self.cursor = None # Offset of the last session shown
+        self.more = True
+        self.loading = False
+
+        self.store = Gtk.ListStore(str, str, str, str, str)
+        treeview = Gtk.TreeView(model=self.store)
+        if log.failures:
+            columns = [(_("Time"), 0), (_("Terminal"), 3), (_("From"), 4)]
+        else:
+            columns = [(_("Login"), 0), (_("Logout"), 1), (_("Duration"), 2), (_("Terminal"), 3), (_("From"), 4)]
+        for title, column_id in columns:
+            column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text=column_id)
+            column.set_resizable(True)
+            treeview.append_column(column)
+        self.scrolled_window = Gtk.ScrolledWindow()
+        self.scrolled_window.set_shadow_type(Gtk.ShadowType.IN)
+        self.scrolled_window.add(treeview)
+        self.scrolled_window.connect("edge-reached", self._on_edge_reached)
+        self.pack_start(self.scrolled_window, True, True, 0)
+
+        self.status_label = Gtk.Label()
+        self.status_label.set_alignment(0.0, 0.5)
+        self.status_label.get_style_context().add_class("dim-label")
+        self.pack_start(self.status_label, False, False, 0)
+
+        self.show_all()
+        self.load_page()
+
+    def load_page(self):
+        if self.loading or not self.more:
+            return
+        self.loading = True
+        self.status_label.set_text(_("Loading..."))
+        self.load_page_thread(self.cursor)
+
+    @xt.run_async
+    def load_page_thread(self, cursor):
+        sessions, more = self.log.get_sessions(self.user_name, cursor, self.PAGE_SIZE)
+        self.show_page(sessions, more)
+
+    @xt.run_idle
+    def show_page(self, sessions, more):
+        for session in sessions:
+            self.store.append(self.get_row(session))
+        self.loaded += len(sessions)
+        if len(sessions) > 0:
+            self.cursor = sessions[-1].offset
+        self.more = more
+        self.loading = False
+        if self.loaded == 0 and not more:
+            self.status_label.set_text(_("Nothing recorded."))
+        else:
+            self.status_label.set_text("")
+        # Keep going until the list can be scrolled
+        adjustment = self.scrolled_window.get_vadjustment()
+        if more and adjustment.get_upper() <= adjustment.get_page_size():
+            GLib.idle_add(self.load_page)
+
+    def get_row(self, session):
+        login = self.format_time(session.login_time)
+        if session.end == session.END_LOGOUT:
+            logout = self.format_time(session.logout_time)
+        elif session.end == session.END_ACTIVE:
+            logout = _("Still logged in")
+        elif session.end == session.END_DOWN:
+            logout = _("Shutdown")
+        elif session.end == session.END_CRASH:
+            logout = _("Crash")
+        else:
+            logout = ""
+        if session.logout_time is not None:
+            minutes = max(0, session.logout_time - session.login_time) // 60
+            duration = "%d:%02d" % (minutes // 60, minutes % 60)
+        else:
+            duration = ""
+        return [login, logout, duration, session.line, session.host]
+
+    def format_time(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).strftime("%Y.%m.%d %H:%M")
+
+    def _on_edge_reached(self, scrolled_window, position):
+        if position == Gtk.PositionType.BOTTOM:
+            self.load_page()
+
+class LoginHistoryDialog(Gtk.Dialog):
+
+    def __init__ (self, user, parent = None):
+        super(LoginHistoryDialog, self).__init__(None, parent)
+
+        self.set_modal(True)
+        self.set_skip_taskbar_hint(True)
+        self.set_skip_pager_hint(True)
+        self.set_title(_("Login History"))
+        self.set_default_size(650, 450)
+        self.set_border_width(6)
+
+        notebook = Gtk.Notebook()
+        notebook.append_page(LoginHistoryView(wtmp_log, user.get_user_name()), Gtk.Label(label=_("Sessions")))
+        notebook.append_page(LoginHistoryView(btmp_log, user.get_user_name()), Gtk.Label(label=_("Failed Attempts")))
+        self.get_content_area().pack_start(notebook, True, True, 0)
+        notebook.show_all()
+
+        self.add_button(_("Close"), Gtk.ResponseType.CLOSE)
+        self.connect("response", lambda dialog, response_id: self.destroy())
+
+# Edits the supplementary groups of a user. The boxes are filled from the
+# group index, and all the changes made in the dialog are written at once.
+class GroupsDialog(Gtk.Dialog):
+
+    def __init__ (self, user, parent = None):
+        super(GroupsDialog, self).__init__(None, parent)
+
+        self.set_modal(True)
+        self.set_skip_taskbar_hint(True)
+        self.set_skip_pager_hint(True)
+        self.set_title(_("Groups"))
+        self.set_default_size(350, 450)
+        self.set_border_width(6)
+
+        self.user_name = user.get_user_name()
+        try:
+            self.primary_gid = pwd.getpwnam(self.user_name).pw_gid
+        except KeyError:
+            self.primary_gid = None
+        self.group_index = get_group_index()
+        self.original = set(self.group_index.get_groups_of_user(self.user_name))
+        self.selected = set(self.original)
+        self.check_buttons = {} # group -> check button
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.connect("search-changed", lambda entry: self.listbox.invalidate_filter())
+        box.pack_start(self.search_entry, False, False, 0)
+        self.listbox = Gtk.ListBox()
+        self.listbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.listbox.set_filter_func(self.filter_row)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled_window.add(self.listbox)
+        box.pack_start(scrolled_window, True, True, 0)
+        self.error_label = Gtk.Label()
+        self.error_label.set_line_wrap(True)
+        self.error_label.set_alignment(0.0, 0.5)
+        box.pack_start(self.error_label, False, False, 0)
+        self.get_content_area().pack_start(box, True, True, 0)
+        box.show_all()
+        self.error_label.hide()
+
+        self.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL, _("Apply"), Gtk.ResponseType.OK)
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.connect("response", self._on_response)
+
+        self.fill()
+        self.changed_id = self.group_index.connect("changed", self._on_groups_changed)
+        self.connect("destroy", lambda widget: self.group_index.disconnect(self.changed_id))
+
+    def fill(self):
+        for row in self.listbox.get_children():
+            self.listbox.remove(row)
+        self.check_buttons = {}
+        for group in self.group_index.get_group_names():
+            check_button = Gtk.CheckButton(label=group)
+            check_button.set_margin_start(6)
+            if self.group_index.get_gid(group) == self.primary_gid:
+                check_button.set_active(True)
+                check_button.set_sensitive(False)
+                check_button.set_tooltip_text(_("This is the primary group of the user."))
+            else:
+                check_button.set_active(group in self.selected)
+                check_button.connect("toggled", self._on_group_toggled, group)
+            self.check_buttons[group] = check_button
+            self.listbox.add(check_button)
+        self.listbox.show_all()
+
+    def filter_row(self, row):
+        text = self.search_entry.get_text().strip().lower()
+        return text in row.get_child().get_label().lower()
+
+    def _on_group_toggled(self, check_button, group):
+        if check_button.get_active():
+            self.selected.add(group)
+        else:
+            self.selected.discard(group)
+        self.set_response_sensitive(Gtk.ResponseType.OK, self.selected != self.original)
+
+    # The groups were changed outside the dialog, keep the edits made in it on top of them
+    def _on_groups_changed(self, group_index):
+        current = set(group_index.get_groups_of_user(self.user_name))
+        added = self.selected - self.original
+        removed = self.original - self.selected
+        self.original = current
+        self.selected = (current | added) - removed
+        self.fill()
+        self.set_response_sensitive(Gtk.ResponseType.OK, self.selected != self.original)
+
+    def _on_response(self, dialog, response_id):
+        if response_id != Gtk.ResponseType.OK:
+            self.destroy()
+            return
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.error_label.hide()
+        # usermod -G only lists supplementary groups
+        groups = [group for group in self.selected if self.group_index.get_gid(group) != self.primary_gid]
+        self.apply_groups(groups)
+
+    @xt.run_async
+    def apply_groups(self, groups):
+        error = set_supplementary_groups(self.user_name, groups)
+        self.on_groups_applied(error)
+
+    @xt.run_idle
+    def on_groups_applied(self, error):
+        if error is None:
+            self.destroy()
+            return
+        print(f"Unable to change the groups of '{self.user_name}': {error}")
+        self.error_label.set_markup("<b>%s</b>" % GLib.markup_escape_text(error))
+        self.error_label.show()
+        self.set_response_sensitive(Gtk.ResponseType.OK, True)
+
+# Gives new, generated passwords to many users at once. The credentials are
+# saved to a file first, then all the passwords are set with one chpasswd
+# call, and optionally expired with one update of /etc/shadow.
+class BulkPasswordDialog(Gtk.Dialog):
+
+    def __init__ (self, users, parent = None):
+        super(BulkPasswordDialog, self).__init__(None, parent)
+
+        self.users = users
+        self.running = False
+
+        self.set_modal(True)
+        self.set_skip_taskbar_hint(True)
+        self.set_skip_pager_hint(True)
+        self.set_title(_("Reset Passwords"))
+        self.set_default_size(450, -1)
+        self.set_border_width(6)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=12)
+        box.set_border_width(6)
+        label = Gtk.Label(label=_("New passwords will be generated for %d users and saved to a file of your choice. Users whose home directory is encrypted are skipped.") % len(users))
+        label.set_line_wrap(True)
+        label.set_max_width_chars(50)
+        label.set_alignment(0.0, 0.5)
+        box.pack_start(label, False, False, 0)
+        self.expire_check = Gtk.CheckButton(label=_("Require a password change at next login"))
+        self.expire_check.set_active(True)
+        box.pack_start(self.expire_check, False, False, 0)
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_line_wrap(True)
+        self.summary_label.set_max_width_chars(50)
+        self.summary_label.set_selectable(True)
+        self.summary_label.set_alignment(0.0, 0.5)
+        box.pack_start(self.summary_label, False, False, 0)
+        self.get_content_area().pack_start(box, True, True, 0)
+        box.show_all()
+
+        self.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL, _("Reset Passwords"), Gtk.ResponseType.OK)
+        self.get_widget_for_response(Gtk.ResponseType.OK).get_style_context().add_class("destructive-action")
+        self.connect("response", self._on_response)
+        self.connect("delete-event", lambda widget, event: self.running)
+
+    def _on_response(self, dialog, response_id):
+        if self.running:
+            return
+        if response_id != Gtk.ResponseType.OK:
+            self.destroy()
+            return
+        path = self.choose_sheet_path()
+        if path is None:
+            return
+        self.running = True
+        self.set_response_sensitive(Gtk.ResponseType.OK, False)
+        self.set_response_sensitive(Gtk.ResponseType.CANCEL, False)
+        self.expire_check.set_sensitive(False)
+        self.summary_label.set_text(_("Resetting passwords..."))
+        entries = [(user.get_user_name(), user.get_real_name()) for user in self.users]
+        self.reset_passwords(entries, path, self.expire_check.get_active())
+
+    def choose_sheet_path(self):
+        chooser = Gtk.FileChooserDialog(title=_("Save the new passwords"), transient_for=self, action=Gtk.FileChooserAction.SAVE)
+        chooser.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL, _("Save"), Gtk.ResponseType.ACCEPT)
+        chooser.set_do_overwrite_confirmation(True)
+        chooser.set_current_name("passwords-%s.csv" % datetime.date.today().strftime("%Y%m%d"))
+        path = chooser.get_filename() if chooser.run() == Gtk.ResponseType.ACCEPT else None
+        chooser.destroy()
+        return path
+
+    @xt.run_async
+    def reset_passwords(self, entries, path, expire):
+        failures = {} # username -> error, the password wasn't changed
+        expire_failures = {} # username -> error, the password was changed but not expired
+        notes = []
+        credentials = [] # (username, full name, password)
+        for user_name, real_name in entries:
+            if os.path.exists("/home/.ecryptfs/%s" % user_name):
+                failures[user_name] = _("The home directory is encrypted, only the user can change this password.")
+            else:
+                credentials.append((user_name, real_name, generate_password()))
+        # Save the sheet before anything is changed, so no password gets lost
+        try:
+            write_credential_sheet(path, credentials)
+        except OSError as e:
+            self.show_summary(len(entries), 0, {}, {}, [_("Unable to save the passwords, none was changed: %s") % e])
+            return
+        failures.update(set_passwords([(user_name, password) for user_name, real_name, password in credentials]))
+        credentials = [entry for entry in credentials if entry[0] not in failures]
+        if len(failures) > 0:
+            # The sheet is replaced atomically, if that fails the first one is still complete
+            try:
+                write_credential_sheet(path, credentials)
+            except OSError as e:
+                print(f"Unable to update '{path}': {e}")
+                notes.append(_("The file still lists the users whose password couldn't be reset."))
+        if expire and len(credentials) > 0:
+            try:
+                for user_name in expire_passwords([entry[0] for entry in credentials]):
+                    expire_failures[user_name] = _("Not a local account.")
+            except OSError as e:
+                for user_name, real_name, password in credentials:
+                    expire_failures[user_name] = str(e)
+        self.show_summary(len(entries), len(credentials), failures, expire_failures, notes)
+
+    @xt.run_idle
+    def show_summary(self, num_total, num_reset, failures, expire_failures, notes):
+        self.running = False
+        lines = []
+        if num_reset > 0 or len(failures) > 0:
+            lines.append(_("%(done)d of %(total)d passwords reset, %(failed)d failed.") % {"done": num_reset, "total": num_total, "failed": len(failures)})
+        for user_name, message in sorted(failures.items()):
+            print(f"Unable to reset the password of '{user_name}': {message}")
+            lines.append("%s: %s" % (user_name, message))
+        if len(expire_failures) > 0:
+            lines.append(_("%d passwords were reset, but the users won't be asked to change them at next login:") % len(expire_failures))
+            for user_name, message in sorted(expire_failures.items()):
+                print(f"Unable to expire the password of '{user_name}': {message}")
+                lines.append("%s: %s" % (user_name, message))
+        self.summary_label.set_text("\n".join(lines + notes))
+        self.get_widget_for_response(Gtk.ResponseType.OK).hide()
+        self.set_response_sensitive(Gtk.ResponseType.CANCEL, True)
+        self.get_widget_for_response(Gtk.ResponseType.CANCEL).set_label(_("Close"))
+
 class PasswordDialog(Gtk.Dialog):
 
     def __init__ (self, user, password_mask, parent = None):
@@ -267,6 +798,98 @@ class PasswordDialog(Gtk.Dialog):
         else:
             self.set_response_sensitive(Gtk.ResponseType.OK, False)
 
+# A card showing a user in the users grid.
+# Cards are recycled by the grid, so they can be bound to another user at any time.
+class UserCard(Gtk.EventBox):
+
+    def __init__(self):
+        super(UserCard, self).__init__()
+        self.user = None
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.set_margin_start(12)
+        box.set_margin_end(12)
+        box.set_margin_top(12)
+        box.set_margin_bottom(12)
+
+        # Avatar, with a badge when the user is logged in
+        overlay = Gtk.Overlay()
+        overlay.set_halign(Gtk.Align.CENTER)
+        self.image = Gtk.Image()
+        overlay.add(self.image)
+        self.session_badge = Gtk.Box()
+        self.session_badge.set_size_request(16, 16)
+        self.session_badge.set_halign(Gtk.Align.END)
+        self.session_badge.set_valign(Gtk.Align.END)
+        self.session_badge.set_tooltip_text(_("Logged in"))
+        self.session_badge.get_style_context().add_class("session-badge")
+        overlay.add_overlay(self.session_badge)
+        box.pack_start(overlay, False, False, 0)
+
+        # Name
+        self.name_label = Gtk.Label()
+        self.name_label.set_ellipsize(Pango.EllipsizeMode.END)
+        box.pack_start(self.name_label, False, False, 0)
+
+        # Username (secondary text)
+        self.user_label = Gtk.Label()
+        self.user_label.set_ellipsize(Pango.EllipsizeMode.END)
+        self.user_label.get_style_context().add_class("dim-label")
+        box.pack_start(self.user_label, False, False, 0)
+
+        # Admin or not
+        self.admin_box = Gtk.Box()
+        image = Gtk.Image.new_from_icon_name("xsi-dialog-password-symbolic", Gtk.IconSize.MENU)
+        admin_label = Gtk.Label(label=_("Administrator"))
+        admin_label.get_style_context().add_class("dim-label")
+        self.admin_box.pack_start(image, False, False, 6)
+        self.admin_box.pack_start(admin_label, False, False, 0)
+        box.pack_start(self.admin_box, False, False, 0)
+
+        # Background job in progress (encryption, removal), shown instead of the admin row
+        self.status_box = Gtk.Box()
+        spinner = Gtk.Spinner(active=True)
+        self.status_label = Gtk.Label()
+        self.status_label.set_ellipsize(Pango.EllipsizeMode.END)
+        self.status_label.get_style_context().add_class("dim-label")
+        self.status_box.pack_start(spinner, False, False, 6)
+        self.status_box.pack_start(self.status_label, False, False, 0)
+        box.pack_start(self.status_box, False, False, 0)
+
+        self.add(box)
+        self.connect("enter-notify-event", lambda w, e: box.get_style_context().add_class("hover"))
+        self.connect("leave-notify-event", lambda w, e: box.get_style_context().remove_class("hover"))
+        box.get_style_context().add_class("user-card")
+        self.show_all()
+        self.admin_box.set_no_show_all(True)
+        self.session_badge.set_no_show_all(True)
+        self.status_box.set_no_show_all(True)
+
+    # All the cards have the same size, whatever they show
+    def do_get_request_mode(self):
+        return Gtk.SizeRequestMode.CONSTANT_SIZE
+
+    def do_get_preferred_width(self):
+        return (USER_CARD_WIDTH, USER_CARD_WIDTH)
+
+    def do_get_preferred_height(self):
+        return (USER_CARD_HEIGHT, USER_CARD_HEIGHT)
+
+    # Show a user, the avatar is loaded in the background with the given priority
+    def bind(self, user, priority, logged_in, home_size=None, status=None, status_tooltip=None):
+        self.user = user
+        self.name_label.set_label(user.get_real_name())
+        if home_size is not None:
+            self.user_label.set_label("%s \u00b7 %s" % (user.get_user_name(), GLib.format_size(home_size)))
+        else:
+            self.user_label.set_label(user.get_user_name())
+        self.admin_box.set_visible(status is None and user.get_account_type() == AccountsService.UserAccountType.ADMINISTRATOR)
+        self.status_box.set_visible(status is not None)
+        self.status_label.set_label(status or "")
+        self.status_box.set_tooltip_text(status_tooltip)
+        self.session_badge.set_visible(logged_in)
+        avatar_bindings.bind(user, self.image, ICON_SIZE_FLOWBOX, ICON_SIZE_FLOWBOX, priority=priority)
+
 class UsersWidget(Gtk.Box):
     def __init__(self, window):
         super().__init__()
@@ -278,18 +901,58 @@ class UsersWidget(Gtk.Box):
         self.main_box = self.builder.get_object("box_users")
         self.stack = self.builder.get_object("users_stack")
         self.user = None # Currently edited user
+        self.load_generation = 0 # Bumped to discard the details of a user that's no longer shown
         self.add(self.main_box)
         self.show_all()
 
-        self.usernames = [] # Keep track of loaded usernames
+        self.users = {} # username -> (user, changed handler id, real name)
+        self.sort_keys = {} # user -> sort key, computed when the real name changes
+        self.search_index = SearchIndex() # user -> username, real name and groups
+        self.user_groups = {} # username -> group names
+        self.pending_changes = {} # username -> (user, change), applied together
+        self.pending_timer = 0
 
         self.builder.get_object("button_add_user").connect("clicked", self.on_user_addition)
+        self.builder.get_object("button_import_users").connect("clicked", self.on_users_import)
         self.builder.get_object("button_user_back").connect("clicked", self.on_back_clicked)
         self.builder.get_object("button_user_remove").connect("clicked", self.on_remove_clicked)
 
-        self.users_flowbox = self.builder.get_object("users_flowbox")
-        self.users_flowbox.connect("child-activated", self.on_user_selected)
-        self.users_flowbox.set_sort_func(self.sort_by_name)
+        self.users_grid = CardGrid(UserCard, self.bind_user_card, USER_CARD_WIDTH, USER_CARD_HEIGHT)
+        self.users_grid.set_sort_key_func(self.get_sort_key)
+        self.users_grid.set_filter_func(self.search_index.is_match)
+        self.users_grid.connect("item-activated", self.on_user_selected)
+        self.users_grid.connect("selection-changed", self.on_selection_changed)
+        self.users_grid.show()
+        self.builder.get_object("users_scrolledwindow").add(self.users_grid)
+
+        self.search_entry = self.builder.get_object("users_search_entry")
+        self.search_entry.connect("search-changed", self.on_search_changed)
+
+        self.batch = None # Batch action in progress
+        self.builder.get_object("button_select_users").connect("toggled", self.on_select_toggled)
+        self.batch_button = self.builder.get_object("button_batch_actions")
+        self.batch_label = self.builder.get_object("label_batch_actions")
+        self.batch_button.hide()
+        menu = Gtk.Menu()
+        for label, action in [(_("Make administrator"), UserBatch.ACTION_ADMINISTRATOR),
+                              (_("Make standard user"), UserBatch.ACTION_STANDARD),
+                              (_("Reset picture"), UserBatch.ACTION_RESET_AVATAR),
+                              (_("Require a password change at next login"), UserBatch.ACTION_EXPIRE_PASSWORD)]:
+            item = Gtk.MenuItem(label=label)
+            item.connect("activate", self.on_batch_action_activated, action)
+            menu.append(item)
+        item = Gtk.MenuItem(label=_("Reset passwords..."))
+        item.connect("activate", self.on_reset_passwords_activated)
+        menu.append(item)
+        menu.append(Gtk.SeparatorMenuItem())
+        item = Gtk.MenuItem(label=_("Select all"))
+        item.connect("activate", lambda item: self.users_grid.select_all())
+        menu.append(item)
+        item = Gtk.MenuItem(label=_("Select none"))
+        item.connect("activate", lambda item: self.users_grid.unselect_all())
+        menu.append(item)
+        menu.show_all()
+        self.batch_button.set_popup(menu)
 
         css_provider = Gtk.CssProvider()
         css_provider.load_from_data(b"""
@@ -302,6 +965,15 @@ class UsersWidget(Gtk.Box):
             .user-card.hover {
                 border-color: alpha(@theme_selected_bg_color, 1.0);
             }
+            .user-card:selected {
+                background-color: alpha(@theme_selected_bg_color, 0.2);
+                border-color: alpha(@theme_selected_bg_color, 1.0);
+            }
+            .session-badge {
+                border-radius: 8px;
+                border: 2px solid @theme_bg_color;
+                background-color: @success_color;
+            }
             """)
 
         screen = Gdk.Screen.get_default()
@@ -315,41 +987,12 @@ class UsersWidget(Gtk.Box):
         self.face_button.set_image(self.face_image)
         self.face_button.set_alignment(0.0, 0.5)
 
-        self.menu = Gtk.Menu()
-
-        separator = Gtk.SeparatorMenuItem()
-        face_browse_menuitem = Gtk.MenuItem(_("Browse for more pictures..."))
-        face_browse_menuitem.connect('activate', self._on_face_browse_menuitem_activated)
+        self.face_picker = FacePicker(self.face_button, ICON_SIZE_CHOOSE_MENU)
+        self.face_picker.connect("face-selected", self._on_face_menuitem_activated)
+        self.face_picker.add_action(_("Browse for more pictures..."), self._on_face_browse_menuitem_activated)
+        self.face_picker.add_action(_("Remove picture"), self._on_face_remove_menuitem_activated)
         self.face_button.connect("button-release-event", self.menu_display)
 
-        row = 0
-        col = 0
-        num_cols = 6
-        face_dirs = ["/usr/share/pixmaps/faces/linuxmint/"]
-        for face_dir in face_dirs:
-            if os.path.exists(face_dir):
-                pictures = sorted(os.listdir(face_dir))
-                for picture in pictures:
-                    path = os.path.join(face_dir, picture)
-                    image = Gtk.Image()
-                    set_image_from_avatar(image, path, ICON_SIZE_CHOOSE_MENU, fallback_size=ICON_SIZE_CHOOSE_MENU)
-                    menuitem = Gtk.MenuItem()
-                    menuitem.add(image)
-                    menuitem.connect('activate', self._on_face_menuitem_activated, path)
-                    self.menu.attach(menuitem, col, col+1, row, row+1)
-                    col = (col+1) % num_cols
-                    if col == 0:
-                        row = row + 1
-
-        row = row + 1
-
-        self.menu.attach(separator, 0, num_cols, row, row+1)
-        self.menu.attach(face_browse_menuitem, 0, num_cols, row+2, row+3)
-
-        face_remove_menuitem = Gtk.MenuItem(_("Remove picture"))
-        face_remove_menuitem.connect('activate', self._on_face_remove_menuitem_activated)
-        self.menu.attach(face_remove_menuitem, 0, num_cols, row+3, row+4)
-
         self.account_type_switch = self.builder.get_object("switch_user_admin")
         self.switch_handler_id = self.account_type_switch.connect("state-set", self._on_accounttype_state_set)
 
@@ -359,17 +1002,33 @@ class UsersWidget(Gtk.Box):
         self.entry_padding = self.realname_entry.entry.get_style_context().get_padding(Gtk.StateFlags.NORMAL).left
         self.builder.get_object("label_user_last_login").set_margin_start(self.entry_padding + 1)
         self.builder.get_object("label_username").set_margin_start(self.entry_padding + 1)
+        self.builder.get_object("label_user_disk_usage").set_margin_start(self.entry_padding + 1)
+        self.groups_label = self.builder.get_object("label_user_groups")
 
         self.password_button_label = self.builder.get_object("label_user_password")
         self.password_button = self.builder.get_object("button_user_password")
         self.password_button.connect('clicked', self._on_password_button_clicked)
+        self.builder.get_object("button_user_login_history").connect("clicked", self._on_login_history_button_clicked)
+        self.builder.get_object("button_user_groups").connect("clicked", self._on_groups_button_clicked)
 
         self.builder.get_object("box_user_avatar").add(self.face_button)
         self.builder.get_object("box_user_realname").add(self.realname_entry)
 
+        self.session_index = get_session_index()
+        self.session_index.connect("changed", self.on_sessions_changed)
+        self.encryption_jobs = get_encryption_jobs()
+        self.encryption_jobs.connect("job-changed", self.on_encryption_job_changed)
+        self.deletion_jobs = get_deletion_jobs()
+        self.deletion_jobs.connect("job-changed", self.on_deletion_job_changed)
+        self.disk_usage = get_disk_usage_monitor()
+        self.disk_usage.connect("usage-changed", self.on_disk_usage_changed)
+        self.group_index = get_group_index()
+        self.group_index.connect("changed", self.on_groups_changed)
+
         self.accountService = AccountsService.UserManager.get_default()
         self.accountService.connect('notify::is-loaded', self.on_accounts_service_ready)
-        self.accountService.connect('user-removed', self.on_accounts_service_ready)
+        self.accountService.connect('user-added', self.on_user_added)
+        self.accountService.connect('user-removed', self.on_user_removed)
 
     @xt.run_async
     def load(self):
@@ -392,10 +1051,40 @@ class UsersWidget(Gtk.Box):
             section.add_row(widget)
         self.show_all()
 
-    def sort_by_name(self, child1, child2):
-        name1 = child1.get_child().user_data.get_real_name().lower()
-        name2 = child2.get_child().user_data.get_real_name().lower()
-        return (name1 > name2) - (name1 < name2)
+    def get_sort_key(self, user):
+        return self.sort_keys[user]
+
+    # Locale-aware order of the real names, usernames break ties
+    def make_sort_key(self, user):
+        # Gtk sets the collation locale, strxfrm() returns a plain str
+        return (locale.strxfrm(user.get_real_name()), user.get_user_name())
+
+    def bind_user_card(self, card, user, priority):
+        user_name = user.get_user_name()
+        home_size = self.disk_usage.get_usage(user.get_home_dir())
+        card.bind(user, priority, self.session_index.is_logged_in(user_name), home_size, *self.get_user_status(user_name))
+
+    # Return the status and its tooltip for a user with a background job, (None, None) otherwise
+    def get_user_status(self, user_name):
+        job = self.deletion_jobs.get_job(user_name)
+        if job is not None and job.state == job.STATE_QUEUED:
+            return (_("Waiting to be removed"), None)
+        elif job is not None and job.state == job.STATE_DELETING:
+            if job.size:
+                return (_("Removing... %d%%") % int(job.progress * 100), GLib.format_size(job.size))
+            return (_("Removing..."), None)
+        job = self.encryption_jobs.get_job(user_name)
+        if job is not None and job.is_active():
+            return (_("Encrypting..."), job.last_line or None)
+        return (None, None)
+
+    def _on_login_history_button_clicked(self, button):
+        dialog = LoginHistoryDialog(self.user, self.window)
+        dialog.show()
+
+    def _on_groups_button_clicked(self, button):
+        dialog = GroupsDialog(self.user, self.window)
+        dialog.show()
 
     def _on_password_button_clicked(self, widget):
         dialog = PasswordDialog(self.user, self.password_button_label, self.window)
@@ -411,56 +1100,113 @@ class UsersWidget(Gtk.Box):
     def _on_realname_changed(self, widget, text):
         self.user.set_real_name(text)
 
-    def _on_face_browse_menuitem_activated(self, menuitem):
+    def _on_face_browse_menuitem_activated(self, button):
         path = browse_avatar_dialog()
         if path:
-            set_avatar_from_browsed_path(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON)
+            set_avatar_from_browsed_path(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON, parent=self.window)
 
-    def _on_face_menuitem_activated(self, menuitem, path):
+    def _on_face_menuitem_activated(self, picker, path):
         if os.path.exists(path):
             set_avatar(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON)
 
-    def _on_face_remove_menuitem_activated(self, menuitem):
+    def _on_face_remove_menuitem_activated(self, button):
         set_avatar(self.user, "", self.face_image, ICON_SIZE_CHOOSE_BUTTON)
 
     def menu_display(self, widget, event):
         if event.button == 1:
-            self.menu.popup(None, None, self.popup_menu_below_button, self.face_button, event.button, event.time)
-            self.menu.show_all()
-
-    def popup_menu_below_button (self, *args):
-        # the introspection for GtkMenuPositionFunc seems to change with each Gtk version,
-        # this is a workaround to make sure we get the menu and the widget
-        menu = args[0]
-        widget = args[-1]
-
-        # here I get the coordinates of the button relative to
-        # window (self.window)
-        button_x, button_y = widget.get_allocation().x, widget.get_allocation().y
+            self.face_picker.popup_for_button()
 
-        # now convert them to X11-relative
-        unused_var, window_x, window_y = widget.get_window().get_origin()
-        x = window_x + button_x
-        y = window_y + button_y
+    def on_accounts_service_ready(self, manager, param):
+        if manager.get_property("is-loaded"):
+            self.load_users()
 
-        # now move the menu below the button
-        y += widget.get_allocation().height
-
-        push_in = True # push_in is True so all menu is always inside screen
-        return x, y, push_in
+    def load_users(self):
+        self.show_users_page()
+        for username in list(self.users.keys()):
+            self.untrack_user(username)
+        users = self.accountService.list_users()
+        for user in users:
+            self.track_user(user)
+        self.users_grid.set_items(users)
+        self.load_user_groups()
 
-    def on_accounts_service_ready(self, user, param):
-        self.load_users()
+    @xt.run_async
+    def load_user_groups(self):
+        try:
+            user_groups = get_user_groups()
+        except OSError as e:
+            print(f"Unable to read the groups: {e}")
+            return
+        self.set_user_groups(user_groups)
 
-    def load_users(self):
+    @xt.run_idle
+    def set_user_groups(self, user_groups):
+        self.user_groups = user_groups
+        for user, changed_id, real_name in self.users.values():
+            self.search_index.set(user, self.get_search_fields(user))
+        if self.search_index.query != "":
+            self.users_grid.refilter()
+
+    def get_search_fields(self, user):
+        user_name = user.get_user_name()
+        return [user_name, user.get_real_name()] + self.user_groups.get(user_name, [])
+
+    def on_search_changed(self, entry):
+        self.search_index.set_query(entry.get_text())
+        self.users_grid.refilter()
+        self.users_grid.get_vadjustment().set_value(0)
+
+    def show_users_page(self):
         self.user = None
+        self.load_generation += 1
+        avatar_bindings.unbind(self.face_image)
         self.stack.set_visible_child_name("page_users")
-        self.users_flowbox.foreach(self.users_flowbox.remove)
-        self.usernames = []
-        users = self.accountService.list_users()
-        for user in users:
-            self.usernames.append(user.get_user_name())
-            self.add_user_widget(user)
+
+    # AccountsService signals often come in bursts (e.g. a user is created and
+    # then has its properties set), so they're queued and applied together.
+    def queue_change(self, user, change):
+        username = user.get_user_name()
+        previous = self.pending_changes.get(username)
+        if previous is not None and previous[1] != "changed" and change == "changed":
+            change = previous[1]
+        self.pending_changes[username] = (user, change)
+        if self.pending_timer == 0:
+            self.pending_timer = GLib.timeout_add(100, self.apply_changes)
+
+    def on_user_added(self, manager, user):
+        self.queue_change(user, "added")
+
+    def on_user_removed(self, manager, user):
+        self.queue_change(user, "removed")
+
+    def on_user_changed(self, user):
+        self.queue_change(user, "changed")
+
+    def apply_changes(self):
+        self.pending_timer = 0
+        resort = False
+        for username, (user, change) in self.pending_changes.items():
+            entry = self.users.get(username)
+            if change == "removed":
+                if entry is not None:
+                    self.remove_user_widget(username)
+                if self.user is not None and self.user.get_user_name() == username:
+                    self.show_users_page()
+            elif entry is None or entry[0] is not user:
+                if entry is not None:
+                    self.remove_user_widget(username)
+                self.add_user_widget(user)
+            else:
+                if entry[2] != user.get_real_name():
+                    self.users[username] = (user, entry[1], user.get_real_name())
+                    self.sort_keys[user] = self.make_sort_key(user)
+                    self.search_index.set(user, self.get_search_fields(user))
+                    resort = True
+                self.users_grid.update_item(user)
+        self.pending_changes = {}
+        if resort:
+            self.users_grid.sort()
+        return False
 
     def load_user(self, user):
         self.user = user
@@ -490,18 +1236,32 @@ class UsersWidget(Gtk.Box):
         else:
             self.account_type_switch.set_active(False)
         self.account_type_switch.handler_unblock(self.switch_handler_id)
-        set_image_from_avatar(self.face_image, user.get_icon_file(), ICON_SIZE_CHOOSE_BUTTON)
+        self.update_remove_button()
+        self.update_disk_usage()
+        self.update_groups()
+
+        # Show the page right away, the avatar and the
+        # encryption status are filled in when they're known
+        self.password_button.set_sensitive(False)
+        self.password_button.set_tooltip_text("")
+        self.builder.get_object("switch_user_encrypted").set_active(False)
+        self.stack.set_visible_child_name("page_user")
 
-        # Count the number of connections for the currently logged-in user
-        connections = int(subprocess.check_output(["w", "-h", user.get_user_name()]).decode("utf-8").count("\n"))
-        if connections > 0:
-            self.builder.get_object("button_user_remove").set_sensitive(False)
-            self.builder.get_object("button_user_remove").set_tooltip_text(_("This user is currently logged in."))
-        else:
-            self.builder.get_object("button_user_remove").set_sensitive(True)
-            self.builder.get_object("button_user_remove").set_tooltip_text("")
+        avatar_bindings.bind(user, self.face_image, ICON_SIZE_CHOOSE_BUTTON, priority=0)
+        self.load_generation += 1
+        self.load_user_details(self.load_generation, user.get_user_name())
+
+    @xt.run_async
+    def load_user_details(self, generation, user_name):
+        encrypted = os.path.exists("/home/.ecryptfs/%s" % user_name)
+        self.show_user_details(generation, encrypted)
 
-        if os.path.exists("/home/.ecryptfs/%s" % user.get_user_name()):
+    @xt.run_idle
+    def show_user_details(self, generation, encrypted):
+        # Discard the details if another user was opened, or the page was left
+        if generation != self.load_generation:
+            return
+        if encrypted or self.encryption_jobs.is_encrypting(self.user.get_user_name()):
             self.password_button.set_sensitive(False)
             self.password_button.set_tooltip_text(_("The user's home directory is encrypted. To preserve access to the encrypted directory, only the user should change this password."))
             self.builder.get_object("switch_user_encrypted").set_active(True)
@@ -510,11 +1270,84 @@ class UsersWidget(Gtk.Box):
             self.password_button.set_tooltip_text("")
             self.builder.get_object("switch_user_encrypted").set_active(False)
 
-        self.stack.set_visible_child_name("page_user")
+    # Logged-in users (or users who may be, until the sessions are known), users being
+    # removed, or users whose home directory is being encrypted, can't be removed
+    def update_remove_button(self):
+        if not self.session_index.is_loaded():
+            self.builder.get_object("button_user_remove").set_sensitive(False)
+            self.builder.get_object("button_user_remove").set_tooltip_text(_("Checking whether this user is logged in..."))
+        elif self.session_index.is_logged_in(self.user.get_user_name()):
+            self.builder.get_object("button_user_remove").set_sensitive(False)
+            self.builder.get_object("button_user_remove").set_tooltip_text(_("This user is currently logged in."))
+        elif self.deletion_jobs.is_deleting(self.user.get_user_name()):
+            self.builder.get_object("button_user_remove").set_sensitive(False)
+            self.builder.get_object("button_user_remove").set_tooltip_text(_("This user is being removed."))
+        elif self.encryption_jobs.is_encrypting(self.user.get_user_name()):
+            self.builder.get_object("button_user_remove").set_sensitive(False)
+            self.builder.get_object("button_user_remove").set_tooltip_text(_("The home directory of this user is being encrypted."))
+        else:
+            self.builder.get_object("button_user_remove").set_sensitive(True)
+            self.builder.get_object("button_user_remove").set_tooltip_text("")
 
+    def on_sessions_changed(self, session_index):
+        self.users_grid.update_items()
+        if self.user is not None:
+            self.update_remove_button()
+
+    def on_encryption_job_changed(self, jobs, job):
+        entry = self.users.get(job.username)
+        if entry is not None:
+            self.users_grid.update_item(entry[0])
+        if self.user is not None and self.user.get_user_name() == job.username:
+            self.update_remove_button()
+            if not job.is_active():
+                self.load_generation += 1
+                self.load_user_details(self.load_generation, job.username)
+
+    def update_disk_usage(self):
+        size = self.disk_usage.get_usage(self.user.get_home_dir())
+        if size is None:
+            self.builder.get_object("label_user_disk_usage").set_text(_("Calculating..."))
+        else:
+            self.builder.get_object("label_user_disk_usage").set_text(GLib.format_size(size))
+
+    # Only the cards on screen (and the user page) show disk usage
+    def on_disk_usage_changed(self, monitor, path):
+        for user in self.users_grid.get_bound_items():
+            if user.get_home_dir() == path:
+                self.users_grid.update_item(user)
+        if self.user is not None and self.user.get_home_dir() == path:
+            self.update_disk_usage()
+
+    def update_groups(self):
+        groups = sorted(self.group_index.get_groups_of_user(self.user.get_user_name()))
+        if len(groups) == 0:
+            self.groups_label.set_text(_("None"))
+        else:
+            self.groups_label.set_text(", ".join(groups))
+        self.groups_label.set_tooltip_text("\n".join(groups))
+
+    # The group files changed, update the page and what the search matches
+    def on_groups_changed(self, group_index):
+        if self.user is not None:
+            self.update_groups()
+        self.load_user_groups()
+
+    def on_deletion_job_changed(self, jobs, job):
+        entry = self.users.get(job.username)
+        if entry is not None:
+            self.users_grid.update_item(entry[0])
+        if self.user is not None and self.user.get_user_name() == job.username:
+            self.update_remove_button()
+        if job.state == job.STATE_FAILED:
+            message = _("The user %s could not be removed.") % job.username
+            dialog = Gtk.MessageDialog(transient_for=self.window, modal=True, message_type=Gtk.MessageType.ERROR, buttons=Gtk.ButtonsType.CLOSE, text=message)
+            dialog.format_secondary_text(job.error)
+            dialog.connect("response", lambda dialog, response_id: dialog.destroy())
+            dialog.show()
 
     def on_back_clicked(self, button):
-        self.load_users()
+        self.show_users_page()
 
     def on_remove_clicked(self, button):
         username = f"`<b>{self.user.get_user_name()}</b>`"
@@ -530,56 +1363,92 @@ class UsersWidget(Gtk.Box):
         r = d.run()
         d.destroy()
         if r == Gtk.ResponseType.YES:
-            result = self.accountService.delete_user_async(self.user, True, None, None)
+            # The removal is queued, the admin can keep working meanwhile
+            self.deletion_jobs.add(self.user)
+            self.show_users_page()
+
+    def track_user(self, user):
+        changed_id = user.connect("changed", self.on_user_changed)
+        self.users[user.get_user_name()] = (user, changed_id, user.get_real_name())
+        self.sort_keys[user] = self.make_sort_key(user)
+        self.search_index.set(user, self.get_search_fields(user))
+
+    def untrack_user(self, username):
+        user, changed_id, real_name = self.users.pop(username)
+        user.disconnect(changed_id)
+        del self.sort_keys[user]
+        self.search_index.remove(user)
+        return user
 
     def add_user_widget(self, user):
-        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
-        box.set_margin_start(12)
-        box.set_margin_end(12)
-        box.set_margin_top(12)
-        box.set_margin_bottom(12)
+        self.track_user(user)
+        self.users_grid.add_item(user)
 
-        image = Gtk.Image()
-        set_image_from_avatar(image, user.get_icon_file(), ICON_SIZE_FLOWBOX, fallback_size=ICON_SIZE_FLOWBOX)
-        box.pack_start(image, False, False, 0)
+    def remove_user_widget(self, username):
+        user = self.untrack_user(username)
+        self.users_grid.remove_item(user)
 
-        # Name
-        name_label = Gtk.Label(label=user.get_real_name())
-        box.pack_start(name_label, False, False, 0)
+    def on_user_selected(self, grid, user):
+        self.load_user(user)
 
-        # Username (secondary text)
-        user_label = Gtk.Label(label=user.get_user_name())
-        user_label.get_style_context().add_class("dim-label")
-        box.pack_start(user_label, False, False, 0)
+    def on_select_toggled(self, button):
+        self.users_grid.set_selection_mode(button.get_active())
+        self.batch_button.set_visible(button.get_active())
+        self.update_batch_button()
 
-        # Admin or not
-        if user.get_account_type() == AccountsService.UserAccountType.ADMINISTRATOR:
-            admin_box = Gtk.Box()
-            image = Gtk.Image.new_from_icon_name("xsi-dialog-password-symbolic", Gtk.IconSize.MENU)
-            admin_label = Gtk.Label(label=_("Administrator"))
-            admin_label.get_style_context().add_class("dim-label")
-            admin_box.pack_start(image, False, False, 6)
-            admin_box.pack_start(admin_label, False, False, 0)
-            box.pack_start(admin_box, False, False, 0)
-
-        event_box = Gtk.EventBox()
-        event_box.add(box)
-        event_box.connect("enter-notify-event", lambda w, e: box.get_style_context().add_class("hover"))
-        event_box.connect("leave-notify-event", lambda w, e: box.get_style_context().remove_class("hover"))
-        event_box.show_all()
-
-        event_box.user_data = user
-        box.get_style_context().add_class("user-card")
+    def on_selection_changed(self, grid):
+        self.update_batch_button()
 
-        self.users_flowbox.add(event_box)
+    def update_batch_button(self):
+        if self.batch is not None:
+            return
+        num_selected = len(self.users_grid.get_selected_items())
+        if num_selected == 0:
+            self.batch_label.set_text(_("No users selected"))
+        else:
+            self.batch_label.set_text(_("%d selected") % num_selected)
+        self.batch_button.set_sensitive(True)
 
-    def on_user_selected(self, flowbox, child):
-        if child is None:
-            self.stack.set_visible_child_name("page_users")
+    # The selected users are all updated by one background job
+    def on_batch_action_activated(self, item, action):
+        users = self.users_grid.get_selected_items()
+        if len(users) == 0 or self.batch is not None:
             return
-        box = child.get_child()
-        user = box.user_data
-        self.load_user(user)
+        self.batch = UserBatch(action, users)
+        self.batch.connect("progress", self.on_batch_progress)
+        self.batch.connect("finished", self.on_batch_finished)
+        self.batch_button.set_sensitive(False)
+        self.batch_label.set_text(_("Updating..."))
+        self.batch.start()
+
+    def on_reset_passwords_activated(self, item):
+        users = self.users_grid.get_selected_items()
+        if len(users) == 0:
+            return
+        dialog = BulkPasswordDialog(users, self.window)
+        dialog.show()
+
+    def on_batch_progress(self, batch, num_done, num_total):
+        self.batch_label.set_text(_("Updating... %(done)d/%(total)d") % {"done": num_done, "total": num_total})
+
+    def on_batch_finished(self, batch):
+        self.batch = None
+        self.users_grid.unselect_all()
+        self.update_batch_button()
+        message = _("%(done)d of %(total)d users updated, %(failed)d failed.") % {"done": len(batch.succeeded), "total": len(batch.users), "failed": len(batch.failed)}
+        if len(batch.failed) > 0:
+            message_type = Gtk.MessageType.WARNING
+        else:
+            message_type = Gtk.MessageType.INFO
+        dialog = Gtk.MessageDialog(transient_for=self.window, modal=True, message_type=message_type, buttons=Gtk.ButtonsType.CLOSE, text=message)
+        if len(batch.failed) > 0:
+            dialog.format_secondary_text("\n".join("%s: %s" % (user_name, error) for user_name, error in batch.failed))
+        dialog.connect("response", lambda dialog, response_id: dialog.destroy())
+        dialog.show()
+
+    def on_users_import(self, button):
+        dialog = ImportUsersDialog(self.window)
+        dialog.show()
 
     def on_user_addition(self, event):
         dialog = NewUserDialog(self.window)
@@ -598,29 +1467,14 @@ class UsersWidget(Gtk.Box):
                     password = dialog.password_entry.get_text()
                     new_user.set_password(password, "")
                     new_user.set_password_mode(AccountsService.UserPasswordMode.REGULAR)
-                    # Encrypt home directory - pass password securely via stdin
-                    proc = subprocess.Popen(["ecryptfs-migrate-home", "-u", username],
-                                          stdin=subprocess.PIPE,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE)
-                    proc.communicate(password.encode())
-                    # Remove backup directory (new user, so it's empty anyway)
-                    import glob
-                    backup_dirs = glob.glob(f"/home/{username}.[A-Za-z0-9]*")
-                    for backup_dir in backup_dirs:
-                        if os.path.isdir(backup_dir):
-                            # Verify the directory is owned by the user before deleting
-                            stat_info = os.stat(backup_dir)
-                            if stat_info.st_uid == new_user.get_uid():
-                                shutil.rmtree(backup_dir)
+                    # Encrypt the home directory in the background
+                    self.encryption_jobs.add(username, new_user.get_uid(), password)
                 else:
                     new_user.set_password_mode(AccountsService.UserPasswordMode.NONE)
 
                 # Add to sudo group if Administrator
                 if dialog.administrator_switch.get_active():
                     subprocess.call(["usermod", "-a", "-G", "sudo", username])
-
-                self.load_users()
             except:
                 print("Failed to create user.")
         dialog.destroy()
@@ -1,23 +1,20 @@
 #!/usr/bin/python3
-import cairo
 import gi
 import glob
-import math
 import os
 import pam
 import pexpect
 import setproctitle
 import sys
-import tempfile
 import time
 import xapp.util
 gi.require_version('AccountsService', '1.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('XApp', '1.0')
 gi.require_version('Gst', '1.0')
-from common.user import generate_password, get_password_strength, set_image_from_avatar, set_avatar, set_avatar_from_browsed_path, browse_avatar_dialog
-from common.widgets import DimmedTable, EditableEntry
-from gi.repository import AccountsService, GLib, Gtk, Gio, Gdk, GdkPixbuf, Gst, GLib
+from common.user import avatar_bindings, avatar_encoding, circular_mask, generate_password, get_pixbuf_array, get_password_strength, set_avatar, set_avatar_from_browsed_path, browse_avatar_dialog
+from common.widgets import DimmedTable, EditableEntry, FacePicker
+from gi.repository import AccountsService, GLib, Gtk, Gio, GdkPixbuf, Gst, GLib
 from PIL import Image
 
 # Initialize GStreamer
@@ -73,44 +70,12 @@ class MainWindow():
         self.face_image.set_size_request(ICON_SIZE_CHOOSE_BUTTON, ICON_SIZE_CHOOSE_BUTTON)
         self.face_button.connect("button-release-event", self.show_menu)
 
-        self.menu = Gtk.Menu()
-        row = 0
-        col = 0
-        num_cols = 6
-        face_dirs = ["/usr/share/pixmaps/faces/linuxmint/"]
-        for face_dir in face_dirs:
-            if os.path.exists(face_dir):
-                pictures = sorted(os.listdir(face_dir))
-                for picture in pictures:
-                    path = os.path.join(face_dir, picture)
-                    image = Gtk.Image()
-                    set_image_from_avatar(image, path, ICON_SIZE_CHOOSE_MENU, fallback_size=ICON_SIZE_CHOOSE_MENU)
-                    menuitem = Gtk.MenuItem()
-                    menuitem.add(image)
-                    menuitem.connect('activate', self.on_avatar_selected, path)
-                    self.menu.attach(menuitem, col, col+1, row, row+1)
-                    col = (col+1) % num_cols
-                    if col == 0:
-                        row = row + 1
-
-        row = row + 1
-        self.menu.attach(Gtk.SeparatorMenuItem(), 0, num_cols, row, row+1)
-
+        self.face_picker = FacePicker(self.face_button, ICON_SIZE_CHOOSE_MENU)
+        self.face_picker.connect("face-selected", self.on_avatar_selected)
         if len(glob.glob("/dev/video*")) > 0:
-            row = row + 1
-            menuitem = Gtk.MenuItem.new_with_label(label=_("Take a photo..."))
-            menuitem.connect('activate', self.on_take_picture)
-            self.menu.attach(menuitem, 0, num_cols, row, row+1)
-
-        row = row + 1
-        menuitem = Gtk.MenuItem(label=_("Browse for more pictures..."))
-        menuitem.connect('activate', self.on_browse_avatars)
-        self.menu.attach(menuitem, 0, num_cols, row, row+1)
-
-        row = row + 1
-        face_remove_menuitem = Gtk.MenuItem(label=_("Remove picture"))
-        face_remove_menuitem.connect('activate', self.on_avatar_removed)
-        self.menu.attach(face_remove_menuitem, 0, num_cols, row, row+1)
+            self.face_picker.add_action(_("Take a photo..."), self.on_take_picture)
+        self.face_picker.add_action(_("Browse for more pictures..."), self.on_browse_avatars)
+        self.face_picker.add_action(_("Remove picture"), self.on_avatar_removed)
 
         self.realname_entry = EditableEntry()
         self.realname_entry.connect("changed", self.on_realname_changed)
@@ -136,49 +101,27 @@ class MainWindow():
         dialog = PasswordDialog(self.user, self.password_button_label, self.window)
         dialog.run()
 
-    def on_browse_avatars(self, menuitem):
+    def on_browse_avatars(self, button):
         path = browse_avatar_dialog()
         if path:
-            set_avatar_from_browsed_path(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON)
+            set_avatar_from_browsed_path(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON, parent=self.window)
 
-    def on_avatar_selected(self, menuitem, path):
+    def on_avatar_selected(self, picker, path):
         set_avatar(self.user, path, self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON)
 
-    def on_avatar_removed(self, menuitem):
+    def on_avatar_removed(self, button):
         set_avatar(self.user, "", self.face_image, ICON_SIZE_CHOOSE_BUTTON, fallback_size=ICON_SIZE_CHOOSE_BUTTON)
 
     def show_menu(self, widget, event):
         if event.button == 1:
-            self.menu.popup(None, None, self.popup_menu_below_button, self.face_button, event.button, event.time)
-            self.menu.show_all()
-
-    def popup_menu_below_button (self, *args):
-        # the introspection for GtkMenuPositionFunc seems to change with each Gtk version,
-        # this is a workaround to make sure we get the menu and the widget
-        menu = args[0]
-        widget = args[-1]
-
-        # here I get the coordinates of the button relative to
-        # window (self.window)
-        button_x, button_y = widget.get_allocation().x, widget.get_allocation().y
-
-        # now convert them to X11-relative
-        unused_var, window_x, window_y = widget.get_window().get_origin()
-        x = window_x + button_x
-        y = window_y + button_y
-
-        # now move the menu below the button
-        y += widget.get_allocation().height
-
-        push_in = True # push_in is True so all menu is always inside screen
-        return x, y, push_in
+            self.face_picker.popup_for_button()
 
     def load_user(self, user, param):
         self.user = user
         self.face_path = os.path.join(user.get_home_dir(), ".face")
         self.builder.get_object("label_username").set_text(user.get_user_name())
         self.realname_entry.set_text(user.get_real_name())
-        set_image_from_avatar(self.face_image, user.get_icon_file(), ICON_SIZE_CHOOSE_BUTTON)
+        avatar_bindings.bind(user, self.face_image, ICON_SIZE_CHOOSE_BUTTON)
         if user.get_password_mode() == AccountsService.UserPasswordMode.REGULAR:
             self.password_button_label.set_text('\u2022\u2022\u2022\u2022\u2022\u2022')
         elif user.get_password_mode() == AccountsService.UserPasswordMode.NONE:
@@ -186,16 +129,15 @@ class MainWindow():
         else:
             self.password_button_label.set_text(_("Set at login"))
 
-    def on_take_picture(self, menuitem):
+    def on_take_picture(self, button):
         dialog = WebcamDialog(self.window)
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             image_data = dialog.get_captured_image()
             if image_data:
-                with tempfile.NamedTemporaryFile(mode='wb', suffix='.png', delete=True) as temp_file:
-                    temp_path = temp_file.name
-                    image_data.save(temp_path, "png")
-                    set_avatar(self.user, temp_path, self.face_image, ICON_SIZE_CHOOSE_BUTTON)
+                temp_path = avatar_encoding.save_to_temp_file(image_data)
+                set_avatar(self.user, temp_path, self.face_image, ICON_SIZE_CHOOSE_BUTTON)
+                os.remove(temp_path)
         dialog.destroy()
 
 class WebcamDialog(Gtk.Dialog):
@@ -268,6 +210,7 @@ class WebcamDialog(Gtk.Dialog):
         self.pipeline = None
         self.current_sample = None
         self.captured_sample = None
+        self.preview_surface = None
 
         self.connect("response", self.on_response)
 
@@ -374,49 +317,25 @@ class WebcamDialog(Gtk.Dialog):
                 if zoom_level > 1.0:
                     crop_width = int(width / zoom_level)
                     crop_height = int(height / zoom_level)
-                    x = (width - crop_width) // 2
-                    y = (height - crop_height) // 2
-                    zoomed_pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, crop_width, crop_height)
-                    pixbuf.copy_area(x, y, crop_width, crop_height, zoomed_pixbuf, 0, 0)
-                    pixbuf = zoomed_pixbuf
+                    pixbuf = pixbuf.new_subpixbuf((width - crop_width) // 2, (height - crop_height) // 2, crop_width, crop_height)
                     width = crop_width
                     height = crop_height
 
+                # The preview is the circle inscribed in the picture once fitted into the preview size
+                diameter = max(1, int(ICON_SIZE_WEBCAM_PREVIEW * min(width, height) / max(width, height)))
+                side = min(width, height)
+                pixbuf = pixbuf.new_subpixbuf((width - side) // 2, (height - side) // 2, side, side)
+                if side != diameter:
+                    pixbuf = pixbuf.scale_simple(diameter, diameter, GdkPixbuf.InterpType.BILINEAR)
+
+                pixels = get_pixbuf_array(pixbuf)
                 # Mirror preview (selfie-style) if enabled
                 if self.mirror_toggle.get_active():
-                    preview_pixbuf = pixbuf.flip(True)
-                else:
-                    preview_pixbuf = pixbuf
-
-                # Scale to fit preview size
-                size = ICON_SIZE_WEBCAM_PREVIEW
-                if width != size or height != size:
-                    scale_factor = min(size / width, size / height)
-                    scaled_w = max(1, int(width * scale_factor))
-                    scaled_h = max(1, int(height * scale_factor))
-                    preview_pixbuf = preview_pixbuf.scale_simple(scaled_w, scaled_h, GdkPixbuf.InterpType.BILINEAR)
-                    width = scaled_w
-                    height = scaled_h
-
-                # Apply circular clipping
-                actual_size = min(width, height)
-                surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, actual_size, actual_size)
-                ctx = cairo.Context(surface)
-
-                # Draw circular clipping path
-                radius = actual_size // 2
-                ctx.arc(radius, radius, radius, math.pi, 3 * math.pi / 2)
-                ctx.arc(actual_size - radius, radius, radius, 3 * math.pi / 2, 0)
-                ctx.arc(actual_size - radius, actual_size - radius, radius, 0, math.pi / 2)
-                ctx.arc(radius, actual_size - radius, radius, math.pi / 2, math.pi)
-                ctx.close_path()
-                ctx.clip()
-
-                # Center the image if needed
-                x_offset = (actual_size - width) // 2
-                y_offset = (actual_size - height) // 2
-                Gdk.cairo_set_source_pixbuf(ctx, preview_pixbuf, x_offset, y_offset)
-                ctx.paint()
+                    pixels = pixels[:, ::-1]
+
+                # Apply circular mask, reusing the surface from the previous frame
+                surface = circular_mask.apply(pixels, self.preview_surface)
+                self.preview_surface = surface
 
                 self.image.set_from_surface(surface)
 
@@ -495,8 +414,8 @@ class WebcamDialog(Gtk.Dialog):
             cropped = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, size, size)
             pixbuf.copy_area(x, y, size, size, cropped, 0, 0)
 
-            # Resize to 512x512
-            scaled = cropped.scale_simple(512, 512, GdkPixbuf.InterpType.HYPER)
+            # Resize to the avatar size
+            scaled = cropped.scale_simple(avatar_encoding.size, avatar_encoding.size, GdkPixbuf.InterpType.HYPER)
 
             buffer.unmap(mapinfo)
 